@@ -0,0 +1,81 @@
+# LDAP based authentication handler for Leihs
+# Copyright 2022 ELAN e.V.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+Benchmark of the cache backends.
+
+Measures the time of cache lookups and updates of the in-process cache, the
+SQLite cache shared by all processes on a host and, if a URL is given, the
+Redis cache. Lookups of shared caches replace requests to LDAP or Leihs which
+the other worker processes would otherwise send again, so they are worth it as
+long as they are much faster than these requests.
+
+Run this from the root of the repository::
+
+    PYTHONPATH=. python benchmarks/cache.py [-n ROUNDS] [--redis URL]
+'''
+
+import argparse
+import os
+import tempfile
+import timeit
+
+from leihsldap.cache import Cache, RedisCache, SQLiteCache
+
+# A typical cached value, the data of a group in Leihs
+GROUP = {'id': '0b8a4fcd-4b5e-4f3a-9c51-0d4f52c3e7c2',
+         'name': 'students',
+         'org_id': 'students',
+         'organization': 'leihs-local'}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('-n', '--rounds', type=int, default=10000,
+                        help='Number of operations per measurement')
+    parser.add_argument('--redis', type=str, default=None,
+                        help='Redis URL, e.g. redis://localhost:6379/0')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        caches = {
+            'memory': Cache(size=args.rounds),
+            'sqlite': SQLiteCache(os.path.join(directory, 'cache.db'),
+                                  size=args.rounds)}
+        if args.redis:
+            caches['redis'] = RedisCache(args.redis, size=args.rounds)
+
+        for backend, cache in caches.items():
+            keys = iter(range(args.rounds))
+            write = timeit.timeit(
+                    lambda: cache.set(f'group{next(keys)}', GROUP),
+                    number=args.rounds)
+            keys = iter(range(args.rounds))
+            hit = timeit.timeit(
+                    lambda: cache.get(f'group{next(keys)}'),
+                    number=args.rounds)
+            miss = timeit.timeit(
+                    lambda: cache.get('missing'),
+                    number=args.rounds)
+            cache.clear()
+            print(f'{backend:>7}: '
+                  f'set {write / args.rounds * 1e6:8.1f} µs   '
+                  f'hit {hit / args.rounds * 1e6:8.1f} µs   '
+                  f'miss {miss / args.rounds * 1e6:8.1f} µs')
+
+
+if __name__ == '__main__':
+    main()
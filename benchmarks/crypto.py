@@ -0,0 +1,125 @@
+# LDAP based authentication handler for Leihs
+# Copyright 2022 ELAN e.V.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+Micro-benchmark of the cryptographic cost of a single login.
+
+A login verifies the request token from Leihs twice (once when rendering the
+login page and once when the form is submitted) and signs a success token.
+This compares passing PEM encoded keys to PyJWT for every operation with the
+pre-parsed keys and the token cache used by the authenticator.
+
+Run this from the root of the repository::
+
+    PYTHONPATH=. python benchmarks/crypto.py [-n ROUNDS]
+'''
+
+import argparse
+import jwt
+import time
+import timeit
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+
+from leihsldap import authenticator
+from leihsldap.config import apply_configuration
+
+
+def generate_key() -> str:
+    '''Generate a PEM encoded ES256 private key.
+    '''
+    key = ec.generate_private_key(ec.SECP256R1())
+    return key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption()).decode()
+
+
+def configure(private_key: str) -> None:
+    '''Apply a minimal configuration using the given key.
+    '''
+    apply_configuration({
+        'leihs': {'url': 'https://leihs.example.com', 'api_token': 'x'},
+        'token': {'private_key': private_key, 'validity': 120},
+        'auth-system': {'id': 'ldap-auth'},
+        'ldap': {'server': 'ldap.example.com',
+                 'user_dn': 'uid={username},ou=people,dc=example,dc=com',
+                 'base_dn': 'ou=people,dc=example,dc=com',
+                 'search_filter': '(uid={username})'},
+        'loglevel': 'WARNING'})
+
+
+def request_token(private_key: str) -> str:
+    '''Create a request token like Leihs would.
+    '''
+    return jwt.encode({
+        'email': 'user@example.com',
+        'login': 'user',
+        'server_base_url': 'https://leihs.example.com',
+        'path': '/sign-in/external-authentication/ldap-auth/sign-in',
+        'exp': int(time.time()) + 3600}, private_key, 'ES256')
+
+
+def login_before(token: str, private_key: str) -> None:
+    '''Cryptographic operations of a login passing PEM encoded keys.
+    '''
+    for _ in range(2):
+        data = jwt.decode(token, private_key, ['ES256'])
+    jwt.encode({'sign_in_request_token': token,
+                'email': data['email'],
+                'iat': int(time.time()),
+                'exp': int(time.time()) + 120,
+                'success': True}, private_key, 'ES256')
+
+
+def login_after(token: str) -> None:
+    '''Cryptographic operations of a login as done by the authenticator.
+    '''
+    authenticator.token_data(token)
+    data, _, _, _ = authenticator.token_data(token)
+    authenticator.response_url(token, data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('-n', '--rounds', type=int, default=1000,
+                        help='Number of simulated logins')
+    args = parser.parse_args()
+
+    private_key = generate_key()
+    configure(private_key)
+
+    # Use a new token for each login, so that caching only helps within
+    # a single login as it does in practice.
+    tokens = [request_token(private_key) for _ in range(args.rounds)]
+    before = iter(tokens)
+    after = iter(tokens)
+
+    results = {
+        'before': timeit.timeit(
+            lambda: login_before(next(before), private_key),
+            number=args.rounds),
+        'after': timeit.timeit(lambda: login_after(next(after)),
+                               number=args.rounds),
+        }
+    for name, seconds in results.items():
+        print(f'{name:>6}: {seconds / args.rounds * 1e6:8.1f} µs per login')
+    print(f'speedup: {results["before"] / results["after"]:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
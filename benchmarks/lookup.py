@@ -0,0 +1,138 @@
+# LDAP based authentication handler for Leihs
+# Copyright 2022 ELAN e.V.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+Micro-benchmark of the LDAP lookup modes.
+
+Logs in users against an offline directory provided by ldap3's mock strategy
+and compares searching the subtree after binding (``search``), reading the
+bound entry directly (``read``) and searching with a service account before
+binding (``service_account``).
+
+The mock strategy has no network latency, so this shows the cost of the
+operations themselves. The number of round trips per login is printed as
+well, since on real networks these usually dominate.
+
+Run this from the root of the repository::
+
+    PYTHONPATH=. python benchmarks/lookup.py [-n ROUNDS] [-u USERS]
+'''
+
+import argparse
+import random
+import timeit
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from ldap3 import Connection, Server, MOCK_SYNC
+
+from leihsldap.config import apply_configuration, settings
+from leihsldap.ldap import fetch_entry, read_user, search_user
+
+BASE_DN = 'ou=people,dc=example,dc=com'
+SERVICE_DN = 'cn=service,dc=example,dc=com'
+
+# Requests sent to the LDAP server per login
+ROUND_TRIPS = {'search': 2, 'read': 2, 'service_account': 3}
+
+
+def configure() -> None:
+    '''Apply a minimal configuration.
+    '''
+    key = ec.generate_private_key(ec.SECP256R1()).private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption()).decode()
+    apply_configuration({
+        'leihs': {'url': 'https://leihs.example.com', 'api_token': 'x'},
+        'token': {'private_key': key, 'validity': 120},
+        'auth-system': {'id': 'ldap-auth'},
+        'ldap': {'server': 'ldap.example.com',
+                 'user_dn': 'uid={username},' + BASE_DN,
+                 'base_dn': BASE_DN,
+                 'search_filter': '(uid={username})',
+                 'userdata': {'email': {'field': 'mail'},
+                              'name': {'family': 'sn', 'given': 'givenName'},
+                              'groups': {'fields': ['ou']}}},
+        'loglevel': 'WARNING'})
+
+
+def directory(users: int) -> Connection:
+    '''Create a connection to an offline directory with the given number of
+    users.
+    '''
+    connection = Connection(Server('ldap.example.com'),
+                            client_strategy=MOCK_SYNC)
+    connection.strategy.add_entry(SERVICE_DN, {'userPassword': 'secret'})
+    for i in range(users):
+        connection.strategy.add_entry(f'uid=user{i},{BASE_DN}', {
+            'uid': f'user{i}',
+            'userPassword': 'password',
+            'mail': f'user{i}@example.com',
+            'givenName': 'Given',
+            'sn': 'Family',
+            'ou': ['students', 'staff'],
+            'objectClass': 'person'})
+    connection.open()
+    return connection
+
+
+def login(connection: Connection, mode: str, username: str) -> dict:
+    '''LDAP operations of a login in the given lookup mode.
+    '''
+    cfg = settings()
+    if mode == 'service_account':
+        connection.rebind(SERVICE_DN, 'secret')
+        user_dn, entry = fetch_entry(
+                connection, cfg.base_dn,
+                cfg.search_filter.format(username=username))
+        connection.rebind(user_dn, 'password')
+        return entry
+    user_dn = cfg.user_dn.format(username=username)
+    connection.rebind(user_dn, 'password')
+    if mode == 'read':
+        return read_user(connection, user_dn)
+    return search_user(connection, username)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('-n', '--rounds', type=int, default=1000,
+                        help='Number of simulated logins')
+    parser.add_argument('-u', '--users', type=int, default=1000,
+                        help='Number of users in the directory')
+    args = parser.parse_args()
+
+    configure()
+    connection = directory(args.users)
+    names = [f'user{random.randrange(args.users)}'
+             for _ in range(args.rounds)]
+
+    results = {}
+    for mode in ROUND_TRIPS:
+        users = iter(names)
+        results[mode] = timeit.timeit(
+                lambda: login(connection, mode, next(users)),
+                number=args.rounds)
+    for mode, seconds in results.items():
+        print(f'{mode:>15}: {seconds / args.rounds * 1e6:10.1f} µs '
+              f'and {ROUND_TRIPS[mode]} round trips per login')
+    print(f'speedup of read over search: '
+          f'{results["search"] / results["read"]:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+# LDAP based authentication handler for Leihs
+# Copyright 2022 ELAN e.V.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+Local stand-ins for LDAP and Leihs used by the benchmarks.
+
+The LDAP directory is provided by ldap3's offline mock strategy. Leihs is
+simulated by a small HTTP server implementing the parts of the admin API used
+by the authenticator, with a configurable delay for every request.
+'''
+
+import json
+import re
+import threading
+import time
+import uuid
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from ldap3 import Connection, MOCK_SYNC
+from urllib.parse import parse_qs, urlparse
+
+from leihsldap import ldap
+
+BASE_DN = 'ou=people,dc=example,dc=com'
+PASSWORD = 'password'
+
+MEMBERSHIP = re.compile(r'^/admin/groups/([^/]+)/users/([^/]+)$')
+AUTH_SYSTEM_USER = re.compile(
+        r'^/admin/system/authentication-systems/[^/]+/users/[^/]+$')
+
+
+class FakeLeihs(ThreadingHTTPServer):
+    '''HTTP server simulating the Leihs admin API.
+    '''
+
+    def __init__(self, latency: float = 0):
+        '''Start the server on a free local port.
+
+        :param latency: Time in seconds to wait before answering a request
+        '''
+        super().__init__(('127.0.0.1', 0), FakeLeihsHandler)
+        self.latency = latency
+        self.users: dict[str, dict] = {}
+        self.groups: dict[str, dict] = {}
+        self.members: set[tuple[str, str]] = set()
+        self.requests = 0
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_port}'
+
+
+class FakeLeihsHandler(BaseHTTPRequestHandler):
+    '''Request handler of :class:`FakeLeihs`.
+    '''
+    server: FakeLeihs
+    protocol_version = 'HTTP/1.1'
+    # Avoid delayed acknowledgements dominating the measured latency
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status: int, data=None):
+        body = json.dumps(data).encode() if data is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self):
+        url = urlparse(self.path)
+        query = {key: value[0] for key, value in parse_qs(url.query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        data = json.loads(self.rfile.read(length)) if length else None
+        time.sleep(self.server.latency)
+        with self.server.lock:
+            self.server.requests += 1
+            status, result = self.route(self.command, url.path, query, data)
+        self.reply(status, result)
+
+    do_GET = do_POST = do_PUT = do_DELETE = handle_request
+
+    def route(self, method: str, path: str, query: dict, data):
+        server = self.server
+        if path == '/admin/users/' and method == 'POST':
+            for user in server.users.values():
+                if data['login'] == user['login'] \
+                        or data['email'] == user['email']:
+                    return 409, {}
+            data['id'] = str(uuid.uuid4())
+            server.users[data['id']] = data
+            return 201, data
+        if path == '/admin/users/' and method == 'GET':
+            term = query.get('term')
+            return 200, {'users': [
+                user for user in server.users.values()
+                if term in (None, user['login'], user['email'])]}
+        if path == '/admin/groups/' and method == 'POST':
+            for group in server.groups.values():
+                if data['org_id'] == group['org_id']:
+                    return 409, {}
+            data['id'] = str(uuid.uuid4())
+            server.groups[data['id']] = data
+            return 201, data
+        if path == '/admin/groups/' and method == 'GET':
+            groups = list(server.groups.values())
+            if 'org_id' in query:
+                groups = [group for group in groups
+                          if group['org_id'] == query['org_id']]
+            if 'including-user' in query:
+                user_id = query['including-user']
+                groups = [group for group in groups
+                          if (group['id'], user_id) in server.members]
+            return 200, {'groups': groups}
+        if match := MEMBERSHIP.match(path):
+            group_id, user_id = match.groups()
+            if group_id not in server.groups or user_id not in server.users:
+                return 404, {}
+            if method == 'PUT':
+                server.members.add((group_id, user_id))
+            elif method == 'DELETE':
+                server.members.discard((group_id, user_id))
+            return 204, None
+        if path == '/admin/system/authentication-systems/':
+            return 409, {}
+        if AUTH_SYSTEM_USER.match(path):
+            return 204, None
+        return 404, {}
+
+
+def fake_directory(users: int, groups: int) -> ldap.ConnectionPool:
+    '''Create an LDAP connection pool working against an offline directory
+    and make it the pool of the current process.
+
+    Users are named ``user0``, ``user1``… and are members of ``groups``
+    groups each.
+
+    :param users: Number of users in the directory
+    :param groups: Number of groups of each user
+    :returns: Connection pool
+    '''
+    pool = ldap.ConnectionPool(ldap.servers(), client_strategy=MOCK_SYNC)
+    connection = Connection(pool.servers[0].server, client_strategy=MOCK_SYNC)
+    for i in range(users):
+        connection.strategy.add_entry(f'uid=user{i},{BASE_DN}', {
+            'uid': f'user{i}',
+            'userPassword': PASSWORD,
+            'mail': f'user{i}@example.com',
+            'givenName': 'Given',
+            'sn': f'Family {i}',
+            'ou': [f'group{j}' for j in range(groups)],
+            'objectClass': 'person'})
+    ldap.install_pool(pool)
+    return pool
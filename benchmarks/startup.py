@@ -0,0 +1,148 @@
+# LDAP based authentication handler for Leihs
+# Copyright 2022 ELAN e.V.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+Benchmark of the start-up time of a worker process.
+
+Starts fresh Python processes importing the Flask application and measures
+how long it takes until the application is imported and until it has served
+its first request. Additionally, it measures how long a worker forked from a
+process with the application already loaded takes to serve its first request,
+like Gunicorn workers do with ``preload_app`` enabled.
+
+Leihs is simulated by a local HTTP server responding with a configurable
+delay, so that the impact of a slow Leihs is visible.
+
+Run this from the root of the repository::
+
+    PYTHONPATH=. python benchmarks/startup.py [-n RUNS] [--latency SECONDS]
+'''
+
+import argparse
+import json
+import os
+import statistics
+import subprocess  # nosec B404
+import sys
+import tempfile
+import threading
+import time
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Code run in the worker process, printing the measured times as JSON
+WORKER = '''
+import json, os, time
+start = time.perf_counter()
+from leihsldap.web import app
+imported = time.perf_counter()
+app.test_client().get('/')
+served = time.perf_counter()
+read, write = os.pipe()
+forked = time.perf_counter()
+if not os.fork():
+    app.test_client().get('/')
+    os.write(write, str(time.perf_counter() - forked).encode())
+    os._exit(0)
+os.wait()
+print(json.dumps({'import': imported - start,
+                  'first request': served - start,
+                  'preloaded': float(os.read(read, 64))}))
+'''
+
+
+def slow_leihs(latency: float) -> ThreadingHTTPServer:
+    '''Start an HTTP server answering every request with a conflict after
+    the given delay, which the authenticator treats as already existing
+    resources.
+    '''
+    class Handler(BaseHTTPRequestHandler):
+        def handle_request(self):
+            time.sleep(latency)
+            length = int(self.headers.get('Content-Length') or 0)
+            self.rfile.read(length)
+            try:
+                self.send_response(409)
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'{}')
+            except ConnectionError:
+                # The worker process exited without waiting for Leihs
+                pass
+
+        do_GET = do_POST = do_PUT = handle_request
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def write_configuration(directory: str, port: int) -> None:
+    '''Write a minimal configuration file to the given directory.
+    '''
+    key = ec.generate_private_key(ec.SECP256R1()).private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption()).decode()
+    cfg = {
+        'leihs': {'url': f'http://127.0.0.1:{port}', 'api_token': 'x'},
+        'token': {'private_key': key, 'validity': 120},
+        'auth-system': {'id': 'ldap-auth', 'url': 'http://127.0.0.1:5000'},
+        'ldap': {'server': 'ldap.example.com',
+                 'user_dn': 'uid={username},ou=people,dc=example,dc=com',
+                 'base_dn': 'ou=people,dc=example,dc=com',
+                 'search_filter': '(uid={username})'},
+        'loglevel': 'WARNING'}
+    # JSON is valid YAML
+    with open(os.path.join(directory, 'leihs-ldap.yml'), 'w') as f:
+        json.dump(cfg, f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('-n', '--runs', type=int, default=5,
+                        help='Number of processes to start')
+    parser.add_argument('--latency', type=float, default=1,
+                        help='Response time of the simulated Leihs')
+    args = parser.parse_args()
+
+    server = slow_leihs(args.latency)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=root)
+    results: dict[str, list[float]] = {}
+    with tempfile.TemporaryDirectory() as directory:
+        write_configuration(directory, server.server_port)
+        for _ in range(args.runs):
+            output = subprocess.run(  # nosec B603
+                    [sys.executable, '-c', WORKER], cwd=directory, env=env,
+                    capture_output=True, check=True, text=True).stdout
+            times = json.loads(output.strip().splitlines()[-1])
+            for name, seconds in times.items():
+                results.setdefault(name, []).append(seconds)
+    server.shutdown()
+
+    for name, values in results.items():
+        print(f'{name:>13}: {statistics.median(values) * 1000:8.1f} ms '
+              f'(median of {len(values)})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+# LDAP based authentication handler for Leihs
+# Copyright 2022 ELAN e.V.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+Benchmark suite measuring the cost of logins against local stand-ins.
+
+Runs the individual stages of a login as well as complete logins through the
+Flask application against an offline LDAP directory and a simulated Leihs
+with configurable latency. Results can be written as JSON and compared
+against the results of a previous run to detect regressions.
+
+Run this from the root of the repository::
+
+    PYTHONPATH=. python benchmarks/suite.py [-n ROUNDS]
+        [--leihs-latency SECONDS] [--output FILE] [--baseline FILE]
+'''
+
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from typing import Callable, Optional
+
+import jwt
+
+from standins import BASE_DN, PASSWORD, FakeLeihs, fake_directory
+
+from leihsldap.config import apply_configuration
+
+# Numbers of groups new users are registered with
+GROUP_COUNTS = (0, 1, 10, 50)
+
+# Number of groups of the users in the directory
+DIRECTORY_GROUPS = 10
+
+
+def configure(leihs_url: str) -> str:
+    '''Apply a configuration using the stand-ins.
+
+    :param leihs_url: URL of the simulated Leihs
+    :returns: PEM encoded private key used for tokens
+    '''
+    key = ec.generate_private_key(ec.SECP256R1()).private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption()).decode()
+    apply_configuration({
+        'leihs': {'url': leihs_url, 'api_token': 'x'},
+        'token': {'private_key': key, 'validity': 120},
+        'auth-system': {'id': 'ldap-auth', 'url': 'http://127.0.0.1:5000'},
+        'ldap': {'server': 'ldap.example.com',
+                 'server_info': 'none',
+                 'user_dn': 'uid={username},' + BASE_DN,
+                 'base_dn': BASE_DN,
+                 'search_filter': '(uid={username})',
+                 'userdata': {'email': {'field': 'mail', 'fallback': True},
+                              'name': {'family': 'sn', 'given': 'givenName'},
+                              'groups': {'fields': ['ou']}}},
+        'loglevel': 'WARNING'})
+    return key
+
+
+def request_token(key: str, email: str, login: Optional[str] = None) -> str:
+    '''Create a request token like Leihs would.
+    '''
+    data = {'email': email,
+            'server_base_url': 'https://leihs.example.com',
+            'path': '/sign-in/external-authentication/ldap-auth/sign-in',
+            'exp': int(time.time()) + 3600}
+    if login:
+        data['login'] = login
+    return jwt.encode(data, key, 'ES256')
+
+
+def measure(function: Callable[[int], object], rounds: int) -> dict:
+    '''Run a function repeatedly and summarize the time it took.
+
+    :param function: Function to call with the number of the round
+    :param rounds: Number of calls
+    :returns: Dictionary with median, 95th percentile and mean in µs
+    '''
+    samples = []
+    for i in range(rounds):
+        start = time.perf_counter()
+        function(i)
+        samples.append((time.perf_counter() - start) * 1e6)
+    samples.sort()
+    return {'median_us': statistics.median(samples),
+            'p95_us': samples[min(len(samples) - 1, int(len(samples) * .95))],
+            'mean_us': statistics.mean(samples),
+            'rounds': rounds}
+
+
+def run(rounds: int, leihs_latency: float) -> dict[str, dict]:
+    '''Run all benchmarks.
+
+    :param rounds: Number of rounds per benchmark
+    :param leihs_latency: Response time of the simulated Leihs in seconds
+    :returns: Results by benchmark name
+    '''
+    leihs = FakeLeihs(leihs_latency)
+    key = configure(leihs.url)
+    fake_directory(rounds, DIRECTORY_GROUPS)
+
+    # Import only after the configuration has been applied
+    from leihsldap.authenticator import response_url, token_data
+    from leihsldap.ldap import ldap_login
+    from leihsldap.leihs_api import register_user
+    from leihsldap.web import app
+
+    results = {}
+    tokens = [request_token(key, f'user{i}@example.com', f'user{i}')
+              for i in range(rounds)]
+    results['token_data'] = measure(
+            lambda i: token_data(tokens[i]), rounds)
+    results['token_data/cached'] = measure(
+            lambda i: token_data(tokens[i]), rounds)
+    results['ldap_login'] = measure(
+            lambda i: ldap_login(f'user{i}', PASSWORD), rounds)
+    data = token_data(tokens[0])[0]
+    results['response_url'] = measure(
+            lambda i: response_url(tokens[i], data), rounds)
+
+    for count in GROUP_COUNTS:
+        groups = [f'group{j}' for j in range(count)]
+        results[f'register_user/new/{count}_groups'] = measure(
+                lambda i: register_user(
+                    f'new{count}-{i}@example.com', 'Given', 'Family',
+                    username=f'new{count}-{i}', groups=groups),
+                rounds)
+    results['register_user/existing'] = measure(
+            lambda i: register_user(
+                f'new0-{i}@example.com', 'Given', 'Family',
+                username=f'new0-{i}'),
+            rounds)
+
+    client = app.test_client()
+    new = [request_token(key, f'user{i}@example.com') for i in range(rounds)]
+    results['login/new_user'] = measure(
+            lambda i: client.post('/', data={'token': new[i],
+                                             'password': PASSWORD}),
+            rounds)
+    results['login/existing_user'] = measure(
+            lambda i: client.post('/', data={'token': tokens[i],
+                                             'password': PASSWORD}),
+            rounds)
+    results['login_page'] = measure(
+            lambda i: client.get('/', query_string={'token': tokens[i]}),
+            rounds)
+
+    leihs.shutdown()
+    return results
+
+
+def compare(results: dict[str, dict], baseline: dict[str, dict],
+            tolerance: float) -> list[str]:
+    '''Compare results against a baseline and print the differences.
+
+    :param results: Current results
+    :param baseline: Results of a previous run
+    :param tolerance: Allowed relative slowdown
+    :returns: Names of benchmarks which got slower than allowed
+    '''
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result['median_us'] / baseline[name]['median_us']
+        marker = ''
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            marker = '  REGRESSION'
+        print(f'{name:<32} {baseline[name]["median_us"]:10.1f} µs -> '
+              f'{result["median_us"]:10.1f} µs ({ratio:5.2f}x){marker}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('-n', '--rounds', type=int, default=200,
+                        help='Number of rounds per benchmark')
+    parser.add_argument('--leihs-latency', type=float, default=0,
+                        help='Response time of the simulated Leihs in seconds')
+    parser.add_argument('--output', type=str, default=None,
+                        help='Write results as JSON to this file')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='Compare results with a previous JSON output')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed relative slowdown compared to the '
+                        'baseline (default: 0.2)')
+    args = parser.parse_args()
+
+    results = run(args.rounds, args.leihs_latency)
+    for name, result in results.items():
+        print(f'{name:<32} median {result["median_us"]:10.1f} µs   '
+              f'p95 {result["p95_us"]:10.1f} µs')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'rounds': args.rounds,
+                       'leihs_latency': args.leihs_latency,
+                       'results': results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)['results']
+        print()
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -19,6 +19,12 @@ from leihsldap.config import update_configuration
 # Default: 1
 workers = multiprocessing.cpu_count()
 
+# Load the application once in the master process before forking workers.
+# This way, configuration and translations are parsed only once
+# and workers start faster.
+# Default: False
+preload_app = True
+
 # Load the leihsldap configuration file from a custom location.
 #
 # By default, leihsldap will try loading configuration from the following
@@ -28,3 +34,44 @@ workers = multiprocessing.cpu_count()
 # - /etc/leihs-ldap.yml
 #
 #update_configuration('/path/to/leihs-ldap.yml')
+
+
+# Remove metrics of exited workers when exposing Prometheus metrics
+# with PROMETHEUS_MULTIPROC_DIR set.
+def child_exit(server, worker):
+    from leihsldap.metrics import mark_process_dead
+    mark_process_dead(worker.pid)
+
+
+# Register the authentication system with Leihs once in the master process,
+# so that not every worker needs to do this. Workers are only started
+# afterwards, so this is limited to a few seconds. If this fails, workers
+# retry the registration in the background.
+def when_ready(server):
+    from leihsldap.config import settings
+    from leihsldap.leihs_api import deadline, register_auth_system
+    try:
+        with deadline(3):
+            register_auth_system()
+    except Exception as e:
+        server.log.warning('Could not register authentication system: %s', e)
+
+    # Prefetched data stay in the worker serving the login page
+    if settings().prefetch and server.cfg.workers > 1:
+        server.log.warning('Prefetching is enabled with %d workers. Logins '
+                           'reaching another worker cannot use prefetched '
+                           'data.', server.cfg.workers)
+
+    # Cached credentials stay in the worker handling the successful login
+    if settings().credential_cache and server.cfg.workers > 1:
+        server.log.warning('Credential caching is enabled with %d workers. '
+                           'During LDAP outages, logins reaching another '
+                           'worker are rejected.', server.cfg.workers)
+
+
+# Reload the leihsldap configuration in the master process on SIGHUP.
+# Since the application is preloaded, new workers inherit the configuration
+# from the master process.
+def on_reload(server):
+    from leihsldap.config import reload_configuration
+    reload_configuration()
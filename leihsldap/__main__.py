@@ -15,8 +15,9 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import argparse
+import sys
 
-from leihsldap.config import update_configuration
+from leihsldap.config import config, update_configuration, watch
 
 
 if __name__ == '__main__':
@@ -30,11 +31,116 @@ if __name__ == '__main__':
         default=None,
         help='Path to a configuration file'
     )
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser(
+        'serve',
+        help='Run the authenticator using the built-in web server (default)'
+    )
+    sync_parser = commands.add_parser(
+        'sync',
+        help='Register all LDAP users missing in Leihs'
+    )
+    sync_parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        help='Only show which users would be registered'
+    )
+    sync_parser.add_argument(
+        '--concurrency',
+        type=int,
+        default=8,
+        help='Number of users to register concurrently (default: 8)'
+    )
+    sync_parser.add_argument(
+        '--checkpoint',
+        type=str,
+        default=None,
+        help='File recording synchronized users to resume interrupted runs'
+    )
+    sync_parser.add_argument(
+        '--page-size',
+        type=int,
+        default=500,
+        help='Number of LDAP entries to request at once (default: 500)'
+    )
+    load_parser = commands.add_parser(
+        'loadtest',
+        help='Simulate logins against a running authenticator'
+    )
+    load_parser.add_argument(
+        'users',
+        type=str,
+        help='File with one login and password per line'
+    )
+    load_parser.add_argument(
+        '--url',
+        type=str,
+        default=None,
+        help='URL of the authenticator (default: auth-system.url)'
+    )
+    load_parser.add_argument(
+        '--duration',
+        type=float,
+        default=60,
+        help='Number of seconds to generate load (default: 60)'
+    )
+    load_parser.add_argument(
+        '--concurrency',
+        type=int,
+        default=10,
+        help='Number of concurrent users or, if --rate is set, the maximum '
+        'number of logins in progress (default: 10)'
+    )
+    load_parser.add_argument(
+        '--rate',
+        type=float,
+        default=None,
+        help='Start logins at this rate per second instead of running a '
+        'fixed number of concurrent users'
+    )
+    load_parser.add_argument(
+        '--returning',
+        type=float,
+        default=.8,
+        help='Share of logins by users already known to Leihs (default: 0.8)'
+    )
+    load_parser.add_argument(
+        '--bad-passwords',
+        type=float,
+        default=.05,
+        help='Share of logins with a wrong password (default: 0.05)'
+    )
+    load_parser.add_argument(
+        '--domain',
+        type=str,
+        default='example.com',
+        help='Email domain of new users (default: example.com)'
+    )
     args = parser.parse_args()
-    if args.config:
-        update_configuration(args.config)
+    update_configuration(args.config)
+
+    if args.command == 'sync':
+        from leihsldap.sync import sync
+        stats = sync(dry_run=args.dry_run,
+                     concurrency=args.concurrency,
+                     checkpoint=args.checkpoint,
+                     page_size=args.page_size)
+        sys.exit(1 if stats['failed'] else 0)
+
+    if args.command == 'loadtest':
+        from leihsldap.loadtest import loadtest
+        loadtest(args.url or config('auth-system', 'url'),
+                 args.users,
+                 duration=args.duration,
+                 concurrency=args.concurrency,
+                 rate=args.rate,
+                 returning=args.returning,
+                 bad_passwords=args.bad_passwords,
+                 domain=args.domain)
+        sys.exit(0)
 
     # Since `app` will use the configuration,
     # load it only after we updated the configuration location
+    watch()
     from leihsldap.web import app
     app.run()
@@ -0,0 +1,241 @@
+# LDAP based authentication handler for Leihs
+# Copyright 2022 ELAN e.V.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+Admission control protecting LDAP and Leihs from overload.
+
+The number of logins using a backend at the same time can be limited.
+Requests which cannot get a slot within a given time are rejected early
+instead of piling up. Additionally, failed logins can be limited per user and
+per client address.
+'''
+
+import fcntl
+import logging
+import os
+import random
+import threading
+import time
+
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from leihsldap.cache import BaseCache, create
+from leihsldap.config import config, on_reload, settings
+
+# Logger
+logger = logging.getLogger(__name__)
+
+__failures = None
+__limits: dict[str, Optional['Limit']] = {}
+__lock = threading.Lock()
+
+
+class Overloaded(Exception):
+    '''A backend is busy and the request could not be admitted in time.
+    '''
+
+
+class RateLimited(Exception):
+    '''Too many failed logins for a user or client address.
+    '''
+
+
+class Limit:
+    '''Limit for the number of concurrent users of a backend.
+
+    Without a directory, the limit applies to the current process only.
+    With a directory, slots are represented by locked files in that
+    directory, so that the limit is shared by all processes using it.
+    Locks are released automatically if a process dies.
+    '''
+
+    def __init__(self, name: str, concurrency: int, wait: float = 1,
+                 directory: Optional[str] = None):
+        '''Create a new limit.
+
+        :param name: Name of the backend, used for messages and slot files
+        :param concurrency: Maximum number of concurrent users
+        :param wait: Time in seconds to wait for a free slot
+        :param directory: Directory for slot files shared between processes
+        '''
+        self.name = name
+        self.concurrency = concurrency
+        self.wait = wait
+        self.directory = directory
+        self.__semaphore = threading.BoundedSemaphore(concurrency)
+
+    def __lock_file(self, deadline: float) -> int:
+        '''Lock one of the slot files, waiting until the deadline.
+
+        :returns: File descriptor holding the lock
+        '''
+        slots = list(range(self.concurrency))
+        while True:
+            random.shuffle(slots)
+            for slot in slots:
+                filename = os.path.join(self.directory,  # type: ignore
+                                        f'{self.name}.{slot}.lock')
+                fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o600)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return fd
+                except BlockingIOError:
+                    os.close(fd)
+            if time.monotonic() >= deadline:
+                raise Overloaded(f'No free {self.name} slot')
+            time.sleep(0.01)
+
+    @contextmanager
+    def slot(self, wait: Optional[float] = None) -> Iterator[None]:
+        '''Occupy a slot while the context is active.
+
+        :param wait: Time in seconds to wait for a free slot, overriding the
+            limit's default
+        :raises Overloaded: If no slot became free in time
+        '''
+        wait = self.wait if wait is None else wait
+        if self.directory:
+            fd = self.__lock_file(time.monotonic() + wait)
+            try:
+                yield
+            finally:
+                os.close(fd)
+            return
+        if not self.__semaphore.acquire(timeout=wait):
+            raise Overloaded(f'No free {self.name} slot')
+        try:
+            yield
+        finally:
+            self.__semaphore.release()
+
+
+def get_limit(backend: str) -> Optional[Limit]:
+    '''Get the concurrency limit of a backend, creating it if necessary.
+
+    :param backend: Name of the backend, i.e. `ldap` or `leihs`
+    :returns: Limit or None if the backend is not limited
+    '''
+    if backend not in __limits:
+        with __lock:
+            if backend not in __limits:
+                new_limit = None
+                concurrency = config('admission', backend, 'concurrency')
+                if concurrency:
+                    wait = config('admission', backend, 'wait')
+                    new_limit = Limit(
+                            backend, concurrency,
+                            wait=1 if wait is None else wait,
+                            directory=config('admission', 'directory'))
+                __limits[backend] = new_limit
+    return __limits[backend]
+
+
+@contextmanager
+def limit(backend: str, wait: Optional[float] = None) -> Iterator[None]:
+    '''Limit the concurrent use of a backend according to the configuration.
+
+    :param backend: Name of the backend, i.e. `ldap` or `leihs`
+    :param wait: Time in seconds to wait for a free slot, overriding the
+        configuration
+    :raises Overloaded: If the backend is busy
+    '''
+    backend_limit = get_limit(backend)
+    if not backend_limit:
+        yield
+        return
+    with backend_limit.slot(wait):
+        yield
+
+
+def failures() -> BaseCache:
+    '''Get the cache of recent failed logins, creating it if necessary.
+
+    :returns: Cache mapping users and addresses to times of failed logins
+    '''
+    if __failures is None:
+        globals()['__failures'] = create(
+                'failed_logins',
+                size=config('admission', 'failed_logins', 'size') or 10000,
+                ttl=config('admission', 'failed_logins', 'window') or 300)
+    return __failures  # type: ignore
+
+
+def failure_keys(username: str,
+                 address: Optional[str]) -> list[tuple[str, str, int]]:
+    '''Get the keys failed logins are tracked by, together with the number of
+    failed logins allowed for each key.
+
+    :param username: The user's username
+    :param address: The client's address
+    :returns: List of tuples of key type, key and allowed failed logins
+    '''
+    keys = []
+    cfg = settings()
+    per_user = cfg.failed_logins_per_user
+    per_address = cfg.failed_logins_per_address
+    if per_user:
+        keys.append(('user', username.lower(), per_user))
+    if per_address and address:
+        keys.append(('address', address, per_address))
+    return keys
+
+
+def recent_failures(cache: BaseCache, key: tuple[str, str]) -> list[float]:
+    '''Get the times of failed logins within the configured window.
+    '''
+    window = cache.ttl or 300
+    now = time.time()
+    return [t for t in cache.get(key, []) if now - t < window]
+
+
+def check_failures(username: str, address: Optional[str] = None) -> None:
+    '''Make sure a user or client address has not failed to log in too often
+    recently.
+
+    :param username: The user's username
+    :param address: The client's address
+    :raises RateLimited: If there were too many failed logins
+    '''
+    cache = failures()
+    for kind, key, allowed in failure_keys(username, address):
+        if len(recent_failures(cache, (kind, key))) >= allowed:
+            raise RateLimited(f'Too many failed logins for {kind} {key}')
+
+
+def record_failure(username: str, address: Optional[str] = None) -> None:
+    '''Record a failed login of a user from a client address.
+
+    :param username: The user's username
+    :param address: The client's address
+    '''
+    cache = failures()
+    for kind, key, allowed in failure_keys(username, address):
+        times = recent_failures(cache, (kind, key)) + [time.time()]
+        cache.set((kind, key), times[-allowed:])
+
+
+def reset() -> None:
+    '''Drop all limits and recorded failed logins.
+    This is used after forking and after the configuration has changed.
+    '''
+    globals()['__failures'] = None
+    globals()['__limits'] = {}
+    globals()['__lock'] = threading.Lock()
+
+
+os.register_at_fork(after_in_child=reset)
+on_reload(reset)
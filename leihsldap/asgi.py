@@ -0,0 +1,317 @@
+# LDAP based authentication handler for Leihs
+# Copyright 2022 ELAN e.V.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+Asynchronous ASGI application providing the same user interface as the Flask
+application in :mod:`leihsldap.web`.
+
+Run it using an ASGI server, e.g.::
+
+    uvicorn leihsldap.asgi:app
+
+If the application is mounted under a path prefix, pass the prefix as root
+path, e.g. using ``uvicorn --root-path``.
+
+LDAP and Leihs API requests are handed off to a bounded thread pool, so that
+waiting for a backend never blocks the event loop.
+'''
+
+import asyncio
+import contextvars
+import logging
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+from jwt.exceptions import DecodeError, ExpiredSignatureError
+from ldap3.core.exceptions import LDAPBindError, LDAPPasswordIsMandatoryError
+from typing import Any, Callable, Optional
+from urllib.parse import parse_qs
+from leihsldap import messages, metrics, prefetch
+from leihsldap.admission import Overloaded, RateLimited
+from leihsldap.assets import Assets, stylesheet
+from leihsldap.authenticator import authenticate, token_data
+from leihsldap.config import config, on_reload, settings
+from leihsldap.leihs_api import LeihsUnavailable, start
+from leihsldap.pages import PageCache
+
+# Logger
+logger = logging.getLogger(__name__)
+
+# Maximum size of a request body in bytes
+MAX_BODY_SIZE = 64 * 1024
+
+# Errors rendered as error page, similar to `leihsldap.web.handle_errors`
+ERRORS = (
+    (DecodeError, 'invalid_token', 400, 'Error decoding token'),
+    (ExpiredSignatureError, 'expired_token', 400, 'Token expired'),
+    (LDAPBindError, 'invalid_credentials', 403, 'LDAP login failed'),
+    (LDAPPasswordIsMandatoryError, 'invalid_credentials', 403,
+     'LDAP login failed'),
+    (RateLimited, 'rate_limited', 429, 'Login rejected'),
+    (Overloaded, 'overloaded', 503, 'Login rejected'),
+    (LeihsUnavailable, 'unavailable', 503, 'Leihs unavailable'),
+    )
+
+directory = os.path.dirname(__file__)
+template_folder = config('ui', 'directories', 'template') \
+    or f'{directory}/templates'
+static_folder = config('ui', 'directories', 'static') \
+    or f'{directory}/static'
+assets = Assets(static_folder)
+
+__executor = None
+
+# Path prefix the application is mounted at, for the current request
+__root_path: contextvars.ContextVar[str] = \
+    contextvars.ContextVar('root_path', default='')
+
+
+def url_for(endpoint: str, filename: str = '') -> str:
+    '''Minimal replacement for Flask's ``url_for`` used in the templates.
+
+    :param endpoint: Endpoint to link to. Only `static` is supported.
+    :param filename: Name of the static file
+    :returns: URL path
+    '''
+    if endpoint != 'static':
+        raise ValueError(f'Unsupported endpoint {endpoint}')
+    return f'{__root_path.get()}/static/{assets.url(filename)}'
+
+
+templates = Environment(loader=FileSystemLoader(template_folder),
+                        autoescape=select_autoescape())
+templates.globals['url_for'] = url_for
+templates.globals['stylesheet'] = lambda filename: stylesheet(
+        assets, filename, url_for('static', filename),
+        settings().inline_css)
+
+
+def executor() -> ThreadPoolExecutor:
+    '''Get the thread pool used for blocking backend calls, creating it if
+    necessary.
+
+    :returns: Thread pool
+    '''
+    if not __executor:
+        globals()['__executor'] = ThreadPoolExecutor(
+                max_workers=config('asgi', 'threads') or 64,
+                thread_name_prefix='leihsldap')
+    return __executor  # type: ignore
+
+
+async def blocking(function: Callable, *args) -> Any:
+    '''Run a blocking function in the thread pool without blocking the event
+    loop.
+
+    :param function: Function to call
+    :param args: Arguments to pass to the function
+    :returns: The function's return value
+    '''
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor(), partial(function, *args))
+
+
+class Request:
+    '''Data of an HTTP request.
+    '''
+
+    def __init__(self, scope: dict, body: bytes):
+        self.method = scope['method']
+        self.address = (scope.get('client') or [None])[0]
+        # Routes are relative to the prefix the application is mounted at
+        self.root_path = scope.get('root_path', '').rstrip('/')
+        self.path = scope['path']
+        if self.root_path and self.path.startswith(self.root_path):
+            self.path = self.path[len(self.root_path):] or '/'
+        self.headers = {key.decode('latin-1').lower(): value.decode('latin-1')
+                        for key, value in scope['headers']}
+        self.args = parse_qs(scope['query_string'].decode('latin-1'))
+        self.form = parse_qs(body.decode('utf-8', 'replace'))
+
+    def arg(self, name: str) -> Optional[str]:
+        '''Get a query parameter.
+        '''
+        return (self.args.get(name) or [None])[0]
+
+    def field(self, name: str) -> Optional[str]:
+        '''Get a form field.
+        '''
+        return (self.form.get(name) or [None])[0]
+
+    def language(self) -> str:
+        '''Get the language best matching the request's accepted languages.
+        '''
+        return messages.negotiate(self.headers.get('accept-language'))
+
+
+async def respond(send: Callable, status: int, body: bytes = b'',
+                  headers: Optional[dict[str, str]] = None) -> None:
+    '''Send an HTTP response.
+    '''
+    headers = headers or {}
+    headers.setdefault('content-type', 'text/html; charset=utf-8')
+    headers['content-length'] = str(len(body))
+    await send({'type': 'http.response.start',
+                'status': status,
+                'headers': [(key.encode(), value.encode())
+                            for key, value in headers.items()]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def render(name: str, **context) -> str:
+    '''Render a template.
+    '''
+    return templates.get_template(name).render(**context)
+
+
+pages = PageCache(render)
+on_reload(pages.clear)
+
+
+def error(request: Request, error_id: str) -> bytes:
+    '''Generate error page based on data defined in `error.yml` and the given
+    error identifier. Error pages are rendered only once per language.
+
+    :param request: The request to respond to
+    :param error_id: String identifying the error to render.
+    :returns: Rendered error page
+    '''
+    metrics.outcome(error_id)
+    return pages.error(request.language(), error_id, request.root_path)
+
+
+async def login_page(request: Request, send: Callable) -> None:
+    '''Render login page.
+    This is the page users will end up on when redirected from Leihs.
+    '''
+    token = request.arg('token')
+    if not token:
+        logger.debug('No token provided')
+        return await respond(send, 400, error(request, 'no_token'))
+    # Verified tokens may be cached by a shared backend
+    _, email, user, registered = await blocking(token_data, token)
+    prefetch.schedule(token, user, registered)
+    body = pages.login(request.language(), token, user, request.root_path)
+    metrics.outcome('login_page')
+    await respond(send, 200, body)
+
+
+async def login(request: Request, send: Callable) -> None:
+    '''Handle login POST requests.
+    '''
+    token = request.field('token')
+    password = request.field('password')
+    url = await blocking(authenticate, token, password, request.address)
+    metrics.outcome('success')
+    await respond(send, 302, headers={'location': url})
+
+
+async def prometheus_metrics(request: Request, send: Callable) -> None:
+    '''Expose Prometheus metrics if enabled.
+    '''
+    if not metrics.enabled():
+        return await respond(send, 404, b'Not Found',
+                             {'content-type': 'text/plain'})
+    data, content_type = metrics.render()
+    await respond(send, 200, data, {'content-type': content_type})
+
+
+async def static(request: Request, send: Callable) -> None:
+    '''Serve static files, compressed if the client supports it.
+    '''
+    status, headers, body = assets.response(
+            request.path[len('/static/'):],
+            request.headers.get('accept-encoding'),
+            request.headers.get('if-none-match'))
+    await respond(send, status, body, headers)
+
+
+async def read_body(receive: Callable) -> bytes:
+    '''Read the request body.
+
+    :raises ValueError: If the body is too large
+    '''
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+        if len(body) > MAX_BODY_SIZE:
+            raise ValueError('Request body too large')
+    return body
+
+
+async def lifespan(receive: Callable, send: Callable) -> None:
+    '''Handle ASGI lifespan events.
+    On start-up, the process is prepared and the authentication system is
+    registered in the background, so that start-up never waits for Leihs.
+    '''
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            start()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            executor().shutdown(wait=True)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope: dict, receive: Callable, send: Callable) -> None:
+    '''ASGI application entry point.
+    '''
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+    start()
+
+    try:
+        body = await read_body(receive)
+    except ValueError:
+        return await respond(send, 413, b'Request Entity Too Large',
+                             {'content-type': 'text/plain'})
+    request = Request(scope, body)
+    __root_path.set(request.root_path)
+    routes = {('GET', '/'): login_page,
+              ('POST', '/'): login,
+              ('GET', '/metrics'): prometheus_metrics}
+    if request.method == 'GET' and request.path.startswith('/static/'):
+        route = static
+    elif not (route := routes.get((request.method, request.path))):
+        return await respond(send, 404, b'Not Found',
+                             {'content-type': 'text/plain'})
+
+    try:
+        with metrics.in_progress():
+            await route(request, send)
+    except Exception as e:
+        for exception, error_id, code, message in ERRORS:
+            if isinstance(e, exception):
+                logger.info('%s: %s', message, e)
+                return await respond(send, code, error(request, error_id))
+        logger.exception('Error handling request: %s', e)
+        await respond(send, 500, error(request, 'internal'))
+
+
+messages.load()
+try:
+    pages.prerender()
+except Exception as e:
+    logger.warning('Could not render pages in advance: %s', e)
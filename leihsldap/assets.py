@@ -0,0 +1,189 @@
+# LDAP based authentication handler for Leihs
+# Copyright 2022 ELAN e.V.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+Delivery of static assets.
+
+All files of the static folder are loaded on start-up. Each file is available
+under a fingerprinted name containing a hash of its content, which can be
+cached by browsers forever, and under its original name, which browsers need
+to revalidate. Compressed variants are created once on start-up and chosen
+based on the encodings accepted by the client.
+'''
+
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+
+from markupsafe import Markup
+from typing import Optional
+
+try:
+    import brotli
+except ImportError:
+    brotli = None  # type: ignore
+
+# Logger
+logger = logging.getLogger(__name__)
+
+# Cache-Control header values for fingerprinted and original names
+CACHE_IMMUTABLE = 'public, max-age=31536000, immutable'
+CACHE_REVALIDATE = 'no-cache'
+
+
+class Asset:
+    '''A static file with its compressed variants.
+    '''
+
+    def __init__(self, name: str, content: bytes):
+        '''Load an asset and create compressed variants.
+
+        :param name: Path of the file relative to the static folder
+        :param content: Content of the file
+        '''
+        digest = hashlib.sha256(content).hexdigest()[:16]
+        base, extension = os.path.splitext(name)
+        self.name = name
+        self.fingerprinted = f'{base}.{digest}{extension}'
+        self.etag = digest
+        self.content_type = mimetypes.guess_type(name)[0] \
+            or 'application/octet-stream'
+        if self.content_type.startswith('text/'):
+            self.content_type += '; charset=utf-8'
+        self.variants = {'identity': content}
+        compressed = {'gzip': gzip.compress(content, mtime=0)}
+        if brotli:
+            compressed['br'] = brotli.compress(content)
+        for encoding, data in compressed.items():
+            # Only keep variants actually saving space
+            if len(data) < len(content):
+                self.variants[encoding] = data
+
+    def encoding(self, accept_encoding: Optional[str]) -> str:
+        '''Choose the best variant for the encodings accepted by a client.
+
+        :param accept_encoding: Value of the ``Accept-Encoding`` header
+        :returns: Content encoding
+        '''
+        accepted = set()
+        for item in (accept_encoding or '').split(','):
+            encoding, _, params = item.strip().partition(';')
+            quality = params.strip().removeprefix('q=')
+            if encoding and quality not in ('0', '0.0', '0.00', '0.000'):
+                accepted.add(encoding.strip().lower())
+        for encoding in ('br', 'gzip'):
+            if encoding in self.variants and \
+                    (encoding in accepted or '*' in accepted):
+                return encoding
+        return 'identity'
+
+
+class Assets:
+    '''Collection of all static assets of a folder.
+    '''
+
+    def __init__(self, folder: str):
+        '''Load all files from a folder.
+
+        :param folder: Static folder
+        '''
+        self.folder = folder
+        self.__assets: dict[str, tuple[Asset, bool]] = {}
+        for root, _, files in os.walk(folder):
+            for filename in files:
+                path = os.path.join(root, filename)
+                name = os.path.relpath(path, folder).replace(os.sep, '/')
+                with open(path, 'rb') as f:
+                    asset = Asset(name, f.read())
+                self.__assets[asset.name] = (asset, False)
+                self.__assets[asset.fingerprinted] = (asset, True)
+        logger.debug('Loaded %d static assets from %s',
+                     len(self.__assets) // 2, folder)
+
+    def url(self, name: str) -> str:
+        '''Get the fingerprinted name of an asset.
+
+        :param name: Original name of the asset
+        :returns: Fingerprinted name or the original name if the asset is
+            unknown
+        '''
+        asset, _ = self.__assets.get(name, (None, False))
+        return asset.fingerprinted if asset else name
+
+    def inline(self, name: str) -> Markup:
+        '''Get the content of a stylesheet to be included in a page.
+
+        :param name: Name of the stylesheet
+        :returns: Style element containing the stylesheet
+        :raises KeyError: If the asset is unknown
+        '''
+        asset, _ = self.__assets[name]
+        css = asset.variants['identity'].decode('utf-8')
+        # Prevent the stylesheet from closing the style element
+        css = css.replace('</', '<\\/')
+        return Markup(f'<style>{css}</style>')  # nosec B704
+
+    def response(self, name: str, accept_encoding: Optional[str] = None,
+                 if_none_match: Optional[str] = None
+                 ) -> tuple[int, dict[str, str], bytes]:
+        '''Create a response delivering an asset.
+
+        :param name: Requested name of the asset
+        :param accept_encoding: Value of the ``Accept-Encoding`` header
+        :param if_none_match: Value of the ``If-None-Match`` header
+        :returns: Tuple of status code, headers and body
+        '''
+        asset, fingerprinted = self.__assets.get(name, (None, False))
+        if not asset:
+            return 404, {'content-type': 'text/plain'}, b'Not Found'
+        encoding = asset.encoding(accept_encoding)
+        etag = asset.etag if encoding == 'identity' \
+            else f'{asset.etag}-{encoding}'
+        headers = {
+            'cache-control':
+                CACHE_IMMUTABLE if fingerprinted else CACHE_REVALIDATE,
+            'etag': f'"{etag}"',
+            'vary': 'Accept-Encoding',
+            }
+        if if_none_match:
+            tags = {tag.strip().removeprefix('W/').strip('"')
+                    for tag in if_none_match.split(',')}
+            if etag in tags or '*' in tags:
+                return 304, headers, b''
+        headers['content-type'] = asset.content_type
+        if encoding != 'identity':
+            headers['content-encoding'] = encoding
+        return 200, headers, asset.variants[encoding]
+
+
+def stylesheet(assets: Assets, name: str, url: str, inline: bool) -> Markup:
+    '''Get the HTML to include a stylesheet in a page.
+
+    :param assets: Static assets
+    :param name: Name of the stylesheet
+    :param url: URL of the stylesheet
+    :param inline: Include the stylesheet's content instead of linking it
+    :returns: Style or link element
+    '''
+    if inline:
+        try:
+            return assets.inline(name)
+        except KeyError:
+            logger.warning('Cannot inline unknown stylesheet %s', name)
+    link = Markup('<link type=text/css rel=stylesheet href="{}" />')
+    return link.format(url)
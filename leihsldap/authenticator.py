@@ -14,15 +14,83 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import hashlib
 import jwt
 import logging
 import time
 
-from leihsldap.config import config
+from jwt.exceptions import DecodeError
+from ldap3.core.exceptions import LDAPBindError, LDAPCommunicationError
+from typing import Optional
+
+from leihsldap import admission, credentials, metrics, prefetch
+from leihsldap.cache import Cache
+from leihsldap.config import config, on_reload, settings
+from leihsldap.ldap import ldap_login
+from leihsldap.leihs_api import deadline, forget_user, register_user, \
+    sync_groups
 
 # Logger
 logger = logging.getLogger(__name__)
 
+__tokens: Optional[Cache] = None
+
+
+def verified_tokens() -> Cache:
+    '''Get the cache of verified request tokens, creating it if necessary.
+    The cache is always kept in the memory of the current process. Payloads
+    read from a shared cache could have been written by anyone with access to
+    it and would be trusted without checking their signature.
+
+    :returns: Token cache
+    '''
+    if __tokens is None:
+        globals()['__tokens'] = Cache(
+                size=config('token', 'cache', 'size') or 1024,
+                ttl=config('token', 'cache', 'ttl') or 300,
+                name='tokens')
+    return __tokens  # type: ignore
+
+
+def reset_tokens() -> None:
+    '''Drop all cached tokens.
+    This is used after the configuration, and possibly the key, has changed.
+    '''
+    globals()['__tokens'] = None
+
+
+on_reload(reset_tokens)
+
+
+def decode(token: str) -> dict:
+    '''Verify a JWT token and return its payload.
+    Verified tokens are cached, so that the same token is not verified again
+    when the login form is submitted. Cache entries never outlive the token's
+    expiration time.
+
+    :param token: The JWT token.
+    :returns: Token payload
+    '''
+    if not isinstance(token, str):
+        raise DecodeError('Invalid token type')
+    cache = verified_tokens()
+    key = hashlib.sha256(token.encode()).digest()
+    data = cache.get(key)
+    if data is None:
+        cfg = settings()
+        options = {'verify_exp': not cfg.allow_expired}
+        with metrics.timed('token_decode'):
+            data = jwt.decode(token, cfg.verification_key, ['ES256'],
+                              options)
+        ttl = cache.ttl
+        exp = data.get('exp')
+        if not cfg.allow_expired and isinstance(exp, (int, float)):
+            remaining = exp - time.time()
+            ttl = remaining if ttl is None else min(ttl, remaining)
+        if ttl is None or ttl > 0:
+            cache.set(key, data, ttl=ttl)
+    return data.copy()
+
 
 def token_data(token: str) -> tuple[dict[str, list], str, str, bool]:
     '''Verify JWT token and extract data contained within token.
@@ -31,9 +99,7 @@ def token_data(token: str) -> tuple[dict[str, list], str, str, bool]:
     :returns: Tuple of original data, email, login and if the user is already
         registered
     '''
-    options = {'verify_exp': not config('token', 'allow_expired')}
-    private_key = config('token', 'private_key')
-    data = jwt.decode(token, private_key, ['ES256'], options)
+    data = decode(token)
 
     email = data.get('email')
     login = data.get('login')
@@ -61,18 +127,103 @@ def response_url(token: str, data: dict[str, str]) -> str:
     :param data: User data to pass on to Leihs.
     '''
     # generate success token
+    cfg = settings()
     iat = int(time.time())
-    exp = iat + config('token', 'validity')
-    private_key = config('token', 'private_key')
-    success_token = jwt.encode({
-            'sign_in_request_token': token,
-            'email': data.get('email'),
-            'iat': iat,
-            'exp': exp,
-            'success': True
-            }, private_key, 'ES256')
+    exp = iat + cfg.token_validity
+    with metrics.timed('token_encode'):
+        success_token = jwt.encode({
+                'sign_in_request_token': token,
+                'email': data.get('email'),
+                'iat': iat,
+                'exp': exp,
+                'success': True
+                }, cfg.signing_key, 'ES256')
 
     logger.debug('returning success token: %s', success_token)
     base_url = data['server_base_url']
     path = data['path']
     return f'{base_url}{path}?token={success_token}'
+
+
+def authenticate(token: str, password: str,
+                 address: Optional[str] = None) -> str:
+    '''Authenticate a user against LDAP and make sure the user is registered
+    with Leihs.
+
+    :param token: JWT token received from and signed by Leihs
+    :param password: The password the user tries to sign in with
+    :param address: The client's address used to limit failed logins
+    :returns: URL to redirect the user to
+    :raises RateLimited: If there were too many failed logins
+    :raises Overloaded: If LDAP or Leihs are too busy
+    :raises LeihsUnavailable: If Leihs could not be reached in time
+    '''
+    cfg = settings()
+    start = time.monotonic()
+
+    # verify token and get login data
+    data, email, user, registered = token_data(token)
+
+    # Login to and get user data from LDAP
+    admission.check_failures(user, address)
+    try:
+        with admission.limit('ldap'):
+            user_data = ldap_login(user, password, prefetch.take(token))
+    except LDAPBindError:
+        credentials.forget(user)
+        admission.record_failure(user, address)
+        raise
+    except (admission.Overloaded, LDAPCommunicationError) as e:
+        # Fall back to cached credentials if LDAP is not available
+        if not credentials.enabled():
+            raise
+        try:
+            cached = credentials.verify(user, password)
+        except credentials.Mismatch:
+            admission.record_failure(user, address)
+            raise e
+        if cached is None:
+            raise
+        logger.warning('LDAP unavailable. Logged in user `%s` using cached '
+                       'credentials: %s', user, e)
+        user_data = cached
+    else:
+        credentials.remember(user, password, user_data)
+
+    # Get list of groups the user should be in
+    groups = [group
+              for field in cfg.group_fields
+              for group in user_data[field]]
+
+    # Check if to fall back to the LDAP email address
+    email_invalid = not email or '@' not in email
+    if cfg.email_overwrite or cfg.email_fallback and email_invalid:
+        email = user_data[cfg.email_field][0]
+        data['email'] = email
+
+    # The time budget for requests against Leihs includes the time already
+    # spent on this login.
+    budget = cfg.login_timeout
+    if budget is not None:
+        budget -= time.monotonic() - start
+
+    # Make sure user is registered with Leihs.
+    # Skip this if Leihs already told us it knows the user. If Leihs does not
+    # know the user, the user may have been deleted since it was cached.
+    with deadline(budget), admission.limit('leihs'):
+        if registered:
+            logger.debug('User `%s` is already registered with Leihs', user)
+            sync_groups(user, groups)
+        else:
+            forget_user(user)
+            given = user_data.get(cfg.given_name_field) or [None]
+            family = user_data.get(cfg.family_name_field) or [None]
+            register_user(
+                    email,
+                    firstname=given[0],
+                    lastname=family[0],
+                    username=user,
+                    groups=groups)
+
+    # Redirect back to Leihs with success token
+    return response_url(token, data)
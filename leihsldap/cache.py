@@ -0,0 +1,427 @@
+# LDAP based authentication handler for Leihs
+# Copyright 2022 ELAN e.V.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+Caches with bounded size and limited lifetime of entries.
+
+Caches are kept in the memory of each process by default. Alternatively, they
+can be stored in an SQLite database shared by all worker processes on a host
+or in Redis, shared by all hosts. Entries of shared caches are serialized as
+JSON, so only JSON compatible keys and values can be stored.
+'''
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+from leihsldap import metrics
+from leihsldap.config import settings
+
+# Logger
+logger = logging.getLogger(__name__)
+
+# Number of writes after which shared caches are trimmed to their size
+TRIM_INTERVAL = 64
+
+# Bytes of SQLite databases accessed using memory-mapped I/O
+MMAP_SIZE = 64 * 1024 * 1024
+
+
+def encode_key(key: Hashable) -> str:
+    '''Convert a cache key to a string for storing it in a shared cache.
+
+    :param key: Key of an entry
+    :returns: String representation of the key
+    '''
+    if isinstance(key, str):
+        return key
+    if isinstance(key, bytes):
+        return key.hex()
+    return json.dumps(key)
+
+
+class BaseCache(ABC):
+    '''Common interface of all caches.
+    Caches keep track of hits and misses. Errors of the backend are logged
+    and treated like a cache miss, so that an unavailable cache never causes
+    a login to fail.
+    '''
+
+    def __init__(self, size: int = 1024, ttl: Optional[float] = 300,
+                 name: Optional[str] = None):
+        '''Create a new cache.
+
+        :param size: Maximum number of entries. Once the cache is full,
+            entries are evicted.
+        :param ttl: Time in seconds after which entries expire. Set to None
+            for entries to never expire.
+        :param name: Name used to report cache metrics
+        '''
+        self.name = name
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    @abstractmethod
+    def lookup(self, key: Hashable) -> tuple[bool, Any]:
+        '''Look up an entry in the backend.
+
+        :param key: Key of the entry
+        :returns: Tuple of whether a valid entry was found and its value
+        '''
+
+    @abstractmethod
+    def store(self, key: Hashable, value: Any, ttl: Optional[float]) -> None:
+        '''Store an entry in the backend.
+        '''
+
+    @abstractmethod
+    def remove(self, key: Hashable) -> None:
+        '''Remove an entry from the backend.
+        '''
+
+    @abstractmethod
+    def flush(self) -> None:
+        '''Remove all entries from the backend.
+        '''
+
+    @abstractmethod
+    def count(self) -> int:
+        '''Count the valid entries in the backend.
+        '''
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        '''Get a value from the cache.
+
+        :param key: Key of the entry
+        :param default: Value to return if there is no valid entry
+        :returns: Cached value or default
+        '''
+        try:
+            hit, value = self.lookup(key)
+        except Exception as e:
+            logger.warning('Could not read from cache %s: %s', self.name, e)
+            hit, value = False, None
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        if self.name:
+            metrics.cache(self.name, hit)
+        return value if hit else default
+
+    def set(self, key: Hashable, value: Any,
+            ttl: Optional[float] = None) -> None:
+        '''Add or replace an entry in the cache.
+
+        :param key: Key of the entry
+        :param value: Value to cache
+        :param ttl: Time to live of this entry, overriding the cache's default
+        '''
+        try:
+            self.store(key, value, ttl if ttl is not None else self.ttl)
+        except Exception as e:
+            logger.warning('Could not write to cache %s: %s', self.name, e)
+
+    def delete(self, key: Hashable) -> None:
+        '''Remove an entry from the cache if it exists.
+
+        :param key: Key of the entry
+        '''
+        try:
+            self.remove(key)
+        except Exception as e:
+            logger.warning('Could not delete from cache %s: %s', self.name, e)
+
+    def clear(self) -> None:
+        '''Remove all entries from the cache.
+        '''
+        try:
+            self.flush()
+        except Exception as e:
+            logger.warning('Could not clear cache %s: %s', self.name, e)
+
+    def __len__(self) -> int:
+        try:
+            return self.count()
+        except Exception as e:
+            logger.warning('Could not count entries of cache %s: %s',
+                           self.name, e)
+            return 0
+
+    def stats(self) -> dict[str, int]:
+        '''Get statistics about the cache usage.
+        Hits and misses are counted by each process separately.
+
+        :returns: Dictionary with number of entries, hits and misses
+        '''
+        return {'entries': len(self),
+                'hits': self.hits,
+                'misses': self.misses}
+
+
+class Cache(BaseCache):
+    '''Thread-safe least recently used cache in the memory of the current
+    process whose entries expire after a given time to live.
+    '''
+
+    def __init__(self, size: int = 1024, ttl: Optional[float] = 300,
+                 name: Optional[str] = None):
+        '''Create a new cache.
+
+        :param size: Maximum number of entries. Least recently used entries
+            are evicted once the cache is full.
+        :param ttl: Time in seconds after which entries expire. Set to None
+            for entries to never expire.
+        :param name: Name used to report cache metrics
+        '''
+        super().__init__(size, ttl, name)
+        self.__data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def lookup(self, key: Hashable) -> tuple[bool, Any]:
+        with self.__lock:
+            entry = self.__data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.__data[key]
+                return False, None
+            self.__data.move_to_end(key)
+            return True, entry[1]
+
+    def store(self, key: Hashable, value: Any, ttl: Optional[float]) -> None:
+        expires = time.monotonic() + ttl if ttl is not None else float('inf')
+        with self.__lock:
+            self.__data[key] = (expires, value)
+            self.__data.move_to_end(key)
+            while len(self.__data) > self.size:
+                self.__data.popitem(last=False)
+
+    def remove(self, key: Hashable) -> None:
+        with self.__lock:
+            self.__data.pop(key, None)
+
+    def flush(self) -> None:
+        with self.__lock:
+            self.__data.clear()
+
+    def count(self) -> int:
+        return len(self.__data)
+
+
+class SQLiteCache(BaseCache):
+    '''Cache stored in an SQLite database which can be shared by all processes
+    on a host. The database uses write-ahead logging and memory-mapped I/O,
+    so that reads do not block writes and are served from the page cache.
+
+    The size limit is enforced periodically, evicting the entries which
+    expire first. The cache's name separates its entries from those of other
+    caches in the same database.
+    '''
+
+    def __init__(self, filename: str, size: int = 1024,
+                 ttl: Optional[float] = 300, name: Optional[str] = None):
+        '''Create a new cache.
+
+        :param filename: Path to the database file
+        :param size: Maximum number of entries
+        :param ttl: Time in seconds after which entries expire. Set to None
+            for entries to never expire.
+        :param name: Name of the cache, also used to report cache metrics
+        '''
+        super().__init__(size, ttl, name)
+        self.filename = filename
+        self.namespace = name or ''
+        self.__local = threading.local()
+        self.__writes = 0
+
+    def database(self) -> sqlite3.Connection:
+        '''Get the database connection of the current thread, opening it if
+        necessary. Connections are not reused across forks.
+
+        :returns: Database connection
+        '''
+        db = getattr(self.__local, 'db', None)
+        if db and self.__local.pid == os.getpid():
+            return db
+        db = sqlite3.connect(self.filename, timeout=1, isolation_level=None)
+        db.execute('pragma journal_mode=wal')
+        db.execute('pragma synchronous=normal')
+        db.execute(f'pragma mmap_size={MMAP_SIZE}')
+        db.execute('''create table if not exists cache (
+                        namespace text not null,
+                        key text not null,
+                        value text not null,
+                        expires real,
+                        primary key (namespace, key)) without rowid''')
+        db.execute('''create index if not exists cache_expires
+                      on cache (namespace, expires)''')
+        self.__local.db = db
+        self.__local.pid = os.getpid()
+        return db
+
+    def lookup(self, key: Hashable) -> tuple[bool, Any]:
+        entry = self.database().execute(
+                '''select value from cache where namespace = ? and key = ?
+                   and (expires is null or expires > ?)''',
+                (self.namespace, encode_key(key), time.time())).fetchone()
+        if entry is None:
+            return False, None
+        return True, json.loads(entry[0])
+
+    def store(self, key: Hashable, value: Any, ttl: Optional[float]) -> None:
+        expires = time.time() + ttl if ttl is not None else None
+        db = self.database()
+        db.execute('insert or replace into cache values (?, ?, ?, ?)',
+                   (self.namespace, encode_key(key), json.dumps(value),
+                    expires))
+        self.__writes += 1
+        if self.__writes % TRIM_INTERVAL == 0:
+            self.trim(db)
+
+    def trim(self, db: sqlite3.Connection) -> None:
+        '''Remove expired entries and evict the entries expiring first until
+        the cache does not exceed its size.
+
+        :param db: Database connection
+        '''
+        db.execute('delete from cache where namespace = ? and expires <= ?',
+                   (self.namespace, time.time()))
+        excess = self.count() - self.size
+        if excess > 0:
+            db.execute('''delete from cache where namespace = ? and key in (
+                            select key from cache where namespace = ?
+                            order by expires is null, expires limit ?)''',
+                       (self.namespace, self.namespace, excess))
+
+    def remove(self, key: Hashable) -> None:
+        self.database().execute(
+                'delete from cache where namespace = ? and key = ?',
+                (self.namespace, encode_key(key)))
+
+    def flush(self) -> None:
+        self.database().execute('delete from cache where namespace = ?',
+                                (self.namespace,))
+
+    def count(self) -> int:
+        return self.database().execute(
+                '''select count(*) from cache where namespace = ?
+                   and (expires is null or expires > ?)''',
+                (self.namespace, time.time())).fetchone()[0]
+
+
+class RedisCache(BaseCache):
+    '''Cache stored in Redis or a server speaking the Redis protocol, which
+    can be shared by multiple hosts. This requires the Python package redis.
+
+    Entries expire using Redis' own expiration. Additionally, a sorted set of
+    keys by expiration time is kept to enforce the size limit periodically,
+    evicting the entries which expire first.
+    '''
+
+    def __init__(self, url: str, size: int = 1024,
+                 ttl: Optional[float] = 300, name: Optional[str] = None,
+                 prefix: str = 'leihsldap', timeout: float = .5):
+        '''Create a new cache.
+
+        :param url: Redis URL, e.g. ``redis://localhost:6379/0``
+        :param size: Maximum number of entries
+        :param ttl: Time in seconds after which entries expire. Set to None
+            for entries to never expire.
+        :param name: Name of the cache, also used to report cache metrics
+        :param prefix: Prefix of all keys used by this cache
+        :param timeout: Time in seconds to wait for Redis
+        '''
+        import redis
+        super().__init__(size, ttl, name)
+        self.client = redis.Redis.from_url(url,
+                                           socket_timeout=timeout,
+                                           socket_connect_timeout=timeout)
+        self.prefix = f'{prefix}:{name or ""}:'
+        self.index = f'{prefix}:{name or ""}'
+        self.__writes = 0
+
+    def lookup(self, key: Hashable) -> tuple[bool, Any]:
+        value = self.client.get(self.prefix + encode_key(key))
+        if value is None:
+            return False, None
+        return True, json.loads(value)  # type: ignore
+
+    def store(self, key: Hashable, value: Any, ttl: Optional[float]) -> None:
+        name = self.prefix + encode_key(key)
+        expires = time.time() + ttl if ttl is not None else float('inf')
+        pipeline = self.client.pipeline()
+        pipeline.set(name, json.dumps(value),
+                     px=int(ttl * 1000) if ttl is not None else None)
+        pipeline.zadd(self.index, {name: expires})
+        pipeline.execute()
+        self.__writes += 1
+        if self.__writes % TRIM_INTERVAL == 0:
+            self.trim()
+
+    def trim(self) -> None:
+        '''Forget expired entries and evict the entries expiring first until
+        the cache does not exceed its size.
+        '''
+        self.client.zremrangebyscore(self.index, '-inf', time.time())
+        excess = self.client.zcard(self.index) - self.size  # type: ignore
+        if excess > 0:
+            evicted = self.client.zpopmin(self.index, excess)
+            self.client.delete(*[name for name, _
+                                 in evicted])  # type: ignore
+
+    def remove(self, key: Hashable) -> None:
+        name = self.prefix + encode_key(key)
+        pipeline = self.client.pipeline()
+        pipeline.delete(name)
+        pipeline.zrem(self.index, name)
+        pipeline.execute()
+
+    def flush(self) -> None:
+        names = self.client.zrange(self.index, 0, -1)
+        self.client.delete(self.index, *names)  # type: ignore
+
+    def count(self) -> int:
+        return self.client.zcount(self.index, time.time(),
+                                  '+inf')  # type: ignore
+
+
+def create(name: str, size: int = 1024,
+           ttl: Optional[float] = 300) -> BaseCache:
+    '''Create a cache using the configured backend.
+    Caches with the same name share their entries if a shared backend is
+    used.
+
+    :param name: Name of the cache
+    :param size: Maximum number of entries
+    :param ttl: Time in seconds after which entries expire
+    :returns: New cache
+    '''
+    cfg = settings()
+    if cfg.cache_backend == 'sqlite':
+        return SQLiteCache(cfg.sqlite_path, size=size, ttl=ttl, name=name)
+    if cfg.cache_backend == 'redis':
+        return RedisCache(cfg.redis_url, size=size, ttl=ttl, name=name,
+                          prefix=cfg.redis_prefix, timeout=cfg.redis_timeout)
+    return Cache(size=size, ttl=ttl, name=name)
@@ -0,0 +1,108 @@
+# LDAP based authentication handler for Leihs
+# Copyright 2022 ELAN e.V.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+Circuit breaker failing fast while a backend is unhealthy.
+'''
+
+import logging
+import threading
+import time
+
+from leihsldap import metrics
+
+# Logger
+logger = logging.getLogger(__name__)
+
+# States of a circuit breaker
+CLOSED = 'closed'
+HALF_OPEN = 'half_open'
+OPEN = 'open'
+
+
+class CircuitOpen(Exception):
+    '''The circuit is open and requests are not sent to the backend.
+    '''
+
+
+class CircuitBreaker:
+    '''Circuit breaker tracking consecutive failures of a backend.
+
+    After a number of consecutive failures, the circuit opens and requests are
+    rejected right away. After a while, a single trial request is let through
+    (half-open). If it succeeds, the circuit closes again. Otherwise, it stays
+    open for another period.
+    '''
+
+    def __init__(self, name: str, threshold: int = 5,
+                 reset_time: float = 30):
+        '''Create a new circuit breaker.
+
+        :param name: Name of the backend, used for logging and metrics
+        :param threshold: Number of consecutive failures opening the circuit
+        :param reset_time: Time in seconds before trying the backend again
+        '''
+        self.name = name
+        self.threshold = threshold
+        self.reset_time = reset_time
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = 0.0
+        self.__lock = threading.Lock()
+        metrics.circuit(name, CLOSED)
+
+    def __transition(self, state: str) -> None:
+        '''Change the state of the circuit. Lock must be held.
+        '''
+        if state != self.state:
+            log = logger.warning if state == OPEN else logger.info
+            log('Circuit for %s is now %s', self.name, state)
+            self.state = state
+            metrics.circuit(self.name, state)
+
+    def allow(self) -> None:
+        '''Check if a request may be sent to the backend.
+
+        :raises CircuitOpen: If the circuit is open
+        '''
+        with self.__lock:
+            if self.state == CLOSED:
+                return
+            # Let a trial request through. If a trial request never reports
+            # back, another one is let through after the same time.
+            now = time.monotonic()
+            if now - self.opened >= self.reset_time:
+                self.opened = now
+                self.__transition(HALF_OPEN)
+                return
+        raise CircuitOpen(f'{self.name} is unavailable')
+
+    def success(self) -> None:
+        '''Record a successful request, closing the circuit.
+        '''
+        with self.__lock:
+            self.failures = 0
+            self.__transition(CLOSED)
+
+    def failure(self) -> None:
+        '''Record a failed request, opening the circuit if the threshold is
+        reached or if the trial request failed.
+        '''
+        with self.__lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.threshold:
+                self.opened = time.monotonic()
+                self.__transition(OPEN)
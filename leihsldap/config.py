@@ -16,16 +16,249 @@
 
 '''
 Load and handle Leihs LDAP Authenticator configuration.
+
+The configuration is compiled into an immutable :class:`Settings` object once
+when it is loaded. Reloading the configuration replaces this object as a
+whole, so that requests in progress keep working with a consistent
+configuration.
 '''
 
 import logging
 import os
+import signal
+import threading
+import time
 import yaml
 
+from cryptography.hazmat.primitives.serialization import load_pem_private_key
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import Any, Callable, Mapping, Optional
+
 # Logger
 logger = logging.getLogger(__name__)
 
-__config = {}
+# Configuration keys which must be set
+REQUIRED = (
+    ('leihs', 'url'),
+    ('leihs', 'api_token'),
+    ('token', 'private_key'),
+    ('token', 'validity'),
+    ('auth-system', 'id'),
+    ('ldap', 'server'),
+    )
+
+# Configuration keys which must be set depending on the LDAP lookup mode
+LOOKUP_REQUIRED = {
+    'search': (('ldap', 'user_dn'),
+               ('ldap', 'base_dn'),
+               ('ldap', 'search_filter')),
+    'read': (('ldap', 'user_dn'),),
+    'service_account': (('ldap', 'base_dn'),
+                        ('ldap', 'search_filter'),
+                        ('ldap', 'service_account', 'dn'),
+                        ('ldap', 'service_account', 'password')),
+    }
+
+# Configuration keys which must be set depending on the cache backend
+CACHE_REQUIRED = {
+    'memory': (),
+    'sqlite': (('cache', 'sqlite', 'path'),),
+    'redis': (('cache', 'redis', 'url'),),
+    }
+
+__settings = None
+__next_check = 0.0
+__listeners: list[Callable[[], None]] = []
+__lock = threading.Lock()
+
+
+@dataclass(frozen=True)
+class Settings:
+    '''Compiled configuration.
+    Values used while handling requests are pre-computed.
+    '''
+    raw: Mapping[str, Any] = field(repr=False)
+    filename: Optional[str] = None
+    mtime: Optional[float] = None
+    reload_interval: Optional[float] = None
+    metrics: bool = False
+    inline_css: bool = False
+
+    leihs_url: str = ''
+    api_headers: Mapping[str, str] = field(default_factory=dict, repr=False)
+    group_parallelism: int = 4
+    group_retries: int = 2
+    deferred_provisioning: bool = False
+    group_sync: bool = False
+    group_sync_remove: bool = False
+    failed_logins_per_user: int = 0
+    failed_logins_per_address: int = 0
+    connect_timeout: float = 5
+    read_timeout: float = 30
+    login_timeout: Optional[float] = None
+    retries: int = 2
+    backoff: float = 0.2
+    breaker_threshold: int = 5
+    breaker_reset_time: float = 30
+
+    private_key: str = field(default='', repr=False)
+    public_key: str = field(default='', repr=False)
+    signing_key: Any = field(default=None, repr=False)
+    verification_key: Any = field(default=None, repr=False)
+    token_validity: int = 120
+    allow_expired: bool = False
+
+    ldap_lookup: str = 'search'
+    user_dn: str = ''
+    base_dn: str = ''
+    search_filter: str = ''
+    service_dn: str = ''
+    service_password: str = field(default='', repr=False)
+    ldap_attributes: tuple[str, ...] = ()
+    group_fields: tuple[str, ...] = ()
+    email_field: Optional[str] = None
+    email_overwrite: bool = False
+    email_fallback: bool = False
+    given_name_field: Optional[str] = None
+    family_name_field: Optional[str] = None
+    credential_cache: bool = False
+
+    prefetch: bool = False
+    prefetch_timeout: float = 5
+
+    cache_backend: str = 'memory'
+    sqlite_path: str = ''
+    redis_url: str = field(default='', repr=False)
+    redis_prefix: str = 'leihsldap'
+    redis_timeout: float = 0.5
+
+
+def lookup(cfg: Optional[Mapping], *args) -> Any:
+    '''Get a value from a nested configuration dictionary.
+
+    :param cfg: Configuration dictionary
+    :param args: Keys to follow
+    :returns: Configuration value or None if it is not set
+    '''
+    for key in args:
+        if not isinstance(cfg, Mapping):
+            return None
+        cfg = cfg.get(key)
+    return cfg
+
+
+def freeze(value: Any) -> Any:
+    '''Make a configuration value and all values nested in it immutable.
+
+    :param value: Value loaded from the configuration file
+    :returns: Value with dictionaries replaced by read-only mappings and lists
+        replaced by tuples
+    '''
+    if isinstance(value, dict):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def compile_settings(cfg: dict, filename: Optional[str] = None) -> Settings:
+    '''Validate a configuration and compile it into a settings object.
+
+    :param cfg: Configuration dictionary as loaded from the file
+    :param filename: Name of the configuration file
+    :returns: Settings object
+    :raises ValueError: If the configuration is invalid
+    '''
+    ldap_lookup = lookup(cfg, 'ldap', 'lookup') or 'search'
+    if ldap_lookup not in LOOKUP_REQUIRED:
+        raise ValueError(f'Invalid LDAP lookup mode `{ldap_lookup}`')
+    cache_backend = (lookup(cfg, 'cache', 'backend') or 'memory').lower()
+    if cache_backend not in CACHE_REQUIRED:
+        raise ValueError(f'Invalid cache backend `{cache_backend}`')
+    missing = ['.'.join(keys)
+               for keys in REQUIRED + LOOKUP_REQUIRED[ldap_lookup]
+               + CACHE_REQUIRED[cache_backend]
+               if lookup(cfg, *keys) is None]
+    if missing:
+        raise ValueError(f'Missing configuration keys: {", ".join(missing)}')
+
+    userdata = lookup(cfg, 'ldap', 'userdata') or {}
+    service_account = lookup(cfg, 'ldap', 'service_account')
+    email_field = lookup(userdata, 'email', 'field')
+    family_name_field = lookup(userdata, 'name', 'family')
+    given_name_field = lookup(userdata, 'name', 'given')
+    group_fields = tuple(lookup(userdata, 'groups', 'fields') or [])
+    attributes = [email_field, family_name_field, given_name_field]
+    attributes = tuple(filter(bool, attributes)) + group_fields
+
+    # Parse the key once instead of on every token operation
+    private_key = cfg['token']['private_key']
+    signing_key = load_pem_private_key(private_key.encode(), password=None)
+
+    group_retries = lookup(cfg, 'leihs', 'group_retries')
+    group_sync = lookup(cfg, 'leihs', 'group_sync')
+    failed_logins = lookup(cfg, 'admission', 'failed_logins')
+    timeouts = lookup(cfg, 'leihs', 'timeout')
+    retries = lookup(cfg, 'leihs', 'retries', 'attempts')
+    circuit_breaker = lookup(cfg, 'leihs', 'circuit_breaker')
+
+    return Settings(
+        raw=freeze(cfg),
+        filename=filename,
+        mtime=os.path.getmtime(filename) if filename else None,
+        reload_interval=cfg.get('reload_interval'),
+        metrics=bool(cfg.get('metrics')),
+        inline_css=bool(lookup(cfg, 'ui', 'inline_css')),
+        leihs_url=cfg['leihs']['url'].rstrip('/'),
+        api_headers=MappingProxyType({
+            'Accept': 'application/json',
+            'Content-Type': 'application/json',
+            'Authorization': 'Token ' + cfg['leihs']['api_token']}),
+        group_parallelism=lookup(cfg, 'leihs', 'group_parallelism') or 4,
+        group_retries=2 if group_retries is None else group_retries,
+        deferred_provisioning=bool(
+            lookup(cfg, 'leihs', 'deferred_provisioning', 'enabled')),
+        group_sync=bool(lookup(group_sync, 'enabled')),
+        group_sync_remove=bool(lookup(group_sync, 'remove')),
+        failed_logins_per_user=lookup(failed_logins, 'per_user') or 0,
+        failed_logins_per_address=lookup(failed_logins, 'per_address') or 0,
+        connect_timeout=lookup(timeouts, 'connect') or 5,
+        read_timeout=lookup(timeouts, 'read') or 30,
+        login_timeout=lookup(timeouts, 'login'),
+        retries=2 if retries is None else retries,
+        backoff=lookup(cfg, 'leihs', 'retries', 'backoff') or 0.2,
+        breaker_threshold=lookup(circuit_breaker, 'threshold') or 5,
+        breaker_reset_time=lookup(circuit_breaker, 'reset_time') or 30,
+        private_key=private_key,
+        public_key=lookup(cfg, 'token', 'public_key') or '',
+        signing_key=signing_key,
+        verification_key=signing_key.public_key(),
+        token_validity=int(cfg['token']['validity']),
+        allow_expired=bool(lookup(cfg, 'token', 'allow_expired')),
+        ldap_lookup=ldap_lookup,
+        user_dn=cfg['ldap'].get('user_dn') or '',
+        base_dn=cfg['ldap'].get('base_dn') or '',
+        search_filter=cfg['ldap'].get('search_filter') or '',
+        service_dn=lookup(service_account, 'dn') or '',
+        service_password=lookup(service_account, 'password') or '',
+        ldap_attributes=attributes,  # type: ignore
+        group_fields=group_fields,
+        email_field=email_field,
+        email_overwrite=bool(lookup(userdata, 'email', 'overwrite')),
+        email_fallback=bool(lookup(userdata, 'email', 'fallback')),
+        given_name_field=given_name_field,
+        family_name_field=family_name_field,
+        credential_cache=bool(
+            lookup(cfg, 'ldap', 'credential_cache', 'enabled')),
+        prefetch=bool(lookup(cfg, 'prefetch', 'enabled')),
+        prefetch_timeout=lookup(cfg, 'prefetch', 'timeout') or 5,
+        cache_backend=cache_backend,
+        sqlite_path=lookup(cfg, 'cache', 'sqlite', 'path') or '',
+        redis_url=lookup(cfg, 'cache', 'redis', 'url') or '',
+        redis_prefix=lookup(cfg, 'cache', 'redis', 'prefix') or 'leihsldap',
+        redis_timeout=lookup(cfg, 'cache', 'redis', 'timeout') or .5,
+        )
 
 
 def configuration_file():
@@ -47,23 +280,112 @@ def configuration_file():
         return '/etc/leihs-ldap.yml'
 
 
+def apply_configuration(cfg: dict, filename: Optional[str] = None) -> Settings:
+    '''Compile a configuration and make it the active configuration.
+
+    :param cfg: Configuration dictionary
+    :param filename: Name of the file the configuration was loaded from
+    :returns: The new settings
+    '''
+    new_settings = compile_settings(cfg, filename)
+    with __lock:
+        globals()['__settings'] = new_settings
+        globals()['__next_check'] = \
+            time.monotonic() + (new_settings.reload_interval or 0)
+
+    # update logger
+    loglevel = cfg.get('loglevel', 'INFO').upper()
+    logging.root.setLevel(loglevel)
+    logger.info('Log level set to %s', loglevel)
+
+    return new_settings
+
+
 def update_configuration(filename=None):
     '''Update configuration.
     '''
     cfgfile = filename or configuration_file()
     if not cfgfile:
-        return {}
+        raise FileNotFoundError('No configuration file found')
     print(f'Loading configuration from {cfgfile}')
     with open(cfgfile, 'r') as f:
         cfg = yaml.safe_load(f)
-    globals()['__config'] = cfg
+    apply_configuration(cfg, cfgfile)
+    return cfg
 
-    # update logger
-    loglevel = cfg.get('loglevel', 'INFO').upper()
-    logging.root.setLevel(loglevel)
-    logger.info('Log level set to %s', loglevel)
 
-    return cfg
+def reload_configuration() -> bool:
+    '''Reload the configuration from the file it was loaded from.
+    If the new configuration is invalid, the current configuration is kept.
+    Functions registered via :func:`on_reload` are called after a successful
+    reload.
+
+    :returns: If the configuration was reloaded
+    '''
+    filename = __settings.filename if __settings else None
+    try:
+        update_configuration(filename)
+    except Exception as e:
+        logger.error('Could not reload configuration: %s', e)
+        return False
+    logger.info('Configuration reloaded')
+    for listener in __listeners:
+        listener()
+    return True
+
+
+def on_reload(listener: Callable[[], None]) -> None:
+    '''Register a function to be called after the configuration has been
+    reloaded. Use this to drop state derived from the configuration.
+
+    :param listener: Function to call
+    '''
+    __listeners.append(listener)
+
+
+def watch() -> None:
+    '''Reload the configuration when receiving SIGHUP.
+    This must be called from the main thread.
+    '''
+    signal.signal(signal.SIGHUP, lambda signum, frame: reload_configuration())
+
+
+def check_reload(current: Settings) -> None:
+    '''Reload the configuration if the configuration file has changed.
+    The file is checked at most once per configured reload interval.
+
+    :param current: Currently active settings
+    '''
+    now = time.monotonic()
+    # Avoid contending for the lock on every lookup within the interval
+    if now < __next_check:
+        return
+    with __lock:
+        if now < __next_check:
+            return
+        globals()['__next_check'] = now + (current.reload_interval or 0)
+    try:
+        changed = os.path.getmtime(current.filename) != current.mtime
+    except OSError:
+        return
+    if changed:
+        reload_configuration()
+
+
+def settings() -> Settings:
+    '''Get the active settings, loading the configuration file if it was not
+    loaded before.
+
+    :returns: Settings object
+    '''
+    current = __settings
+    if current is None:
+        update_configuration()
+        current = __settings
+    elif current.reload_interval and current.filename:
+        check_reload(current)
+        current = __settings
+    return current  # type: ignore
 
 
 def config(*args, allow_empty=True):
@@ -74,7 +396,7 @@ def config(*args, allow_empty=True):
     :type key: string
     :return: dictionary containing the configuration or configuration value
     '''
-    cfg = __config or update_configuration()
+    cfg = settings().raw
     for key in args:
         if cfg is None:
             if allow_empty:
@@ -0,0 +1,213 @@
+# LDAP based authentication handler for Leihs
+# Copyright 2022 ELAN e.V.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+Cached credentials allowing users to log in while LDAP is unavailable.
+
+After a successful login, a salted scrypt hash of the password is kept
+together with the user's attributes. The cache is only consulted if the LDAP
+server cannot be reached or is too busy to handle another login. A failed
+login against LDAP immediately removes the user's entry.
+
+Hashes are only ever kept in the memory of the worker process. They are
+never written to disk or shared with other processes or hosts. A user can
+therefore only log in using cached credentials if the login reaches the
+process which handled the user's last successful login. This is always the
+case for the single-process ASGI application, but not for several worker
+processes without sticky routing.
+
+Since hashing is deliberately slow, it is done by a background thread after
+the login has finished.
+'''
+
+import hashlib
+import hmac
+import logging
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from leihsldap import metrics
+from leihsldap.cache import Cache
+from leihsldap.config import config, on_reload, settings
+
+# Logger
+logger = logging.getLogger(__name__)
+
+# Parameters of the key derivation function
+SCRYPT = {'n': 2 ** 14, 'r': 8, 'p': 1}
+
+# Maximum number of hashes waiting to be calculated
+BACKLOG = 64
+
+__credentials = None
+__executor = None
+__lock = threading.Lock()
+__pending: dict[str, object] = {}
+__slots = None
+
+
+class Mismatch(Exception):
+    '''The password does not match the cached credentials.
+    '''
+
+
+def enabled() -> bool:
+    '''Check if credentials are cached.
+    '''
+    return settings().credential_cache
+
+
+def credentials() -> Cache:
+    '''Get the cache of credentials, creating it if necessary.
+
+    :returns: Cache mapping usernames to password hashes and attributes
+    '''
+    if __credentials is None:
+        globals()['__credentials'] = Cache(
+                size=config('ldap', 'credential_cache', 'size') or 1000,
+                ttl=config('ldap', 'credential_cache', 'ttl') or 3600,
+                name='credentials')
+    return __credentials  # type: ignore
+
+
+def executor() -> tuple[ThreadPoolExecutor, threading.BoundedSemaphore]:
+    '''Get the thread calculating hashes and the semaphore limiting the
+    number of waiting hashes, creating them if necessary.
+    A single thread ensures hashes of a user are stored in login order.
+
+    :returns: Thread pool and semaphore
+    '''
+    with __lock:
+        if not __executor:
+            globals()['__executor'] = ThreadPoolExecutor(
+                    max_workers=1,
+                    thread_name_prefix='leihsldap-credentials')
+            globals()['__slots'] = threading.BoundedSemaphore(BACKLOG)
+    return __executor, __slots  # type: ignore
+
+
+def reset() -> None:
+    '''Drop all cached credentials and the hashing thread.
+    This is used after forking since threads do not survive a fork and after
+    the configuration has changed, e.g. to disable the cache.
+    '''
+    globals()['__credentials'] = None
+    globals()['__executor'] = None
+    globals()['__slots'] = None
+    globals()['__pending'] = {}
+    globals()['__lock'] = threading.Lock()
+
+
+os.register_at_fork(after_in_child=reset)
+on_reload(reset)
+
+
+def derive(password: str, salt: bytes, params: dict[str, int]) -> bytes:
+    '''Calculate the hash of a password.
+
+    :param password: Password to hash
+    :param salt: Random salt
+    :param params: scrypt parameters n, r and p
+    :returns: Hash of the password
+    '''
+    with metrics.timed('credential_hash'):
+        return hashlib.scrypt(password.encode(), salt=salt, dklen=32,
+                              **params)
+
+
+def store(username: str, password: str, attributes: dict[str, list],
+          ticket: object) -> None:
+    '''Hash a password and cache it together with the user's attributes.
+    Nothing is cached if the user's credentials have been forgotten or
+    remembered again since the hash has been requested.
+
+    :param ticket: Identifies the request to cache the credentials
+    '''
+    salt = os.urandom(16)
+    entry = {'salt': salt,
+             'params': SCRYPT,
+             'hash': derive(password, salt, SCRYPT),
+             'attributes': attributes}
+    with __lock:
+        if __pending.get(username) is not ticket:
+            logger.debug('Discarding outdated credentials of user `%s`',
+                         username)
+            return
+        del __pending[username]
+        credentials().set(username, entry)
+    logger.debug('Cached credentials of user `%s`', username)
+
+
+def remember(username: str, password: str,
+             attributes: dict[str, list]) -> None:
+    '''Cache the credentials of a user who just logged in successfully.
+    Previously cached credentials are dropped right away, so that they are
+    never used once a newer password has been verified. If too many hashes
+    are waiting to be calculated already, the user is not cached.
+
+    :param username: The user's username
+    :param password: The password verified by LDAP
+    :param attributes: The user's attributes
+    '''
+    if not enabled():
+        return
+    forget(username)
+    pool_executor, slots = executor()
+    if not slots.acquire(blocking=False):
+        logger.debug('Too many credentials waiting to be hashed. '
+                     'Not caching user `%s`', username)
+        return
+    ticket = object()
+    with __lock:
+        __pending[username] = ticket
+    future = pool_executor.submit(store, username, password, attributes,
+                                  ticket)
+    future.add_done_callback(lambda _: slots.release())
+
+
+def forget(username: str) -> None:
+    '''Remove the cached credentials of a user, including credentials still
+    waiting to be hashed.
+
+    :param username: The user's username
+    '''
+    if enabled():
+        with __lock:
+            __pending.pop(username, None)
+            credentials().delete(username)
+
+
+def verify(username: str, password: str) -> Optional[dict[str, list]]:
+    '''Check a password against the cached credentials of a user.
+
+    :param username: The user's username
+    :param password: The password to check
+    :returns: The user's cached attributes if the password matches or None
+        if there are no cached credentials
+    :raises Mismatch: If the password does not match
+    '''
+    if not enabled() or not password:
+        return None
+    entry = credentials().get(username)
+    if not entry:
+        return None
+    password_hash = derive(password, entry['salt'], entry['params'])
+    if not hmac.compare_digest(password_hash, entry['hash']):
+        raise Mismatch(f'Password of user `{username}` does not match')
+    return {key: list(value) for key, value in entry['attributes'].items()}
@@ -0,0 +1,192 @@
+# LDAP based authentication handler for Leihs
+# Copyright 2022 ELAN e.V.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+Durable local job queue for work which does not need to happen while the user
+is waiting. Jobs are stored in an SQLite database, so that they survive
+restarts and can be shared by all worker processes on a host.
+'''
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from typing import Any, Callable, Optional
+
+from leihsldap.config import config, settings
+
+# Logger
+logger = logging.getLogger(__name__)
+
+# Time in seconds a claimed job is reserved for the claiming worker
+LEASE = 300
+
+__handlers: dict[str, Callable[..., Any]] = {}
+__worker: Optional[threading.Thread] = None
+
+
+def enabled() -> bool:
+    '''Check if deferred processing of jobs is enabled.
+
+    :returns: If jobs should be queued
+    '''
+    return settings().deferred_provisioning
+
+
+def handler(kind: str):
+    '''Decorator registering a function as handler for a specific kind of job.
+    The job's payload is passed to the handler as keyword arguments.
+
+    :param kind: Kind of job handled by the function
+    '''
+    def decorator(function):
+        __handlers[kind] = function
+        return function
+    return decorator
+
+
+def database() -> sqlite3.Connection:
+    '''Open the job database, creating the job table if necessary.
+
+    :returns: Database connection
+    '''
+    filename = config('leihs', 'deferred_provisioning', 'queue',
+                      allow_empty=False)
+    db = sqlite3.connect(filename, timeout=30, isolation_level=None)
+    db.execute('pragma journal_mode=wal')
+    db.execute('''create table if not exists jobs (
+                    id integer primary key,
+                    kind text not null,
+                    payload text not null,
+                    attempts integer not null default 0,
+                    run_at real not null,
+                    locked_until real not null default 0,
+                    failed integer not null default 0)''')
+    return db
+
+
+def enqueue(kind: str, **payload) -> None:
+    '''Add a job to the queue.
+
+    :param kind: Kind of job, selecting the handler to run
+    :param payload: Arguments to pass to the handler
+    '''
+    logger.debug('Queuing job `%s`: %s', kind, payload)
+    db = database()
+    try:
+        db.execute('insert into jobs (kind, payload, run_at) values (?, ?, ?)',
+                   (kind, json.dumps(payload), time.time()))
+    finally:
+        db.close()
+    start_worker()
+
+
+def claim(db: sqlite3.Connection) -> Optional[tuple[int, str, str, int]]:
+    '''Claim the next due job. The job is locked for a while so that no other
+    worker picks it up in the meantime.
+
+    :param db: Database connection
+    :returns: Tuple of job id, kind, payload and attempts or None
+    '''
+    now = time.time()
+    db.execute('begin immediate')
+    try:
+        job = db.execute('''select id, kind, payload, attempts from jobs
+                            where not failed and run_at <= ?
+                            and locked_until <= ?
+                            order by run_at limit 1''', (now, now)).fetchone()
+        if job:
+            db.execute('update jobs set locked_until = ? where id = ?',
+                       (now + LEASE, job[0]))
+        db.execute('commit')
+    except Exception:
+        db.execute('rollback')
+        raise
+    return job
+
+
+def run(db: sqlite3.Connection, job: tuple[int, str, str, int]) -> None:
+    '''Run a job and remove it from the queue if it succeeded.
+    Failed jobs are rescheduled with exponential backoff until the maximum
+    number of attempts is reached.
+
+    :param db: Database connection
+    :param job: Job as returned by :func:`claim`
+    '''
+    job_id, kind, payload, attempts = job
+    try:
+        __handlers[kind](**json.loads(payload))
+    except Exception as e:
+        attempts += 1
+        max_attempts = config('leihs', 'deferred_provisioning',
+                              'max_attempts') or 10
+        backoff = config('leihs', 'deferred_provisioning', 'backoff') or 10
+        failed = attempts >= max_attempts
+        delay = min(backoff * 2 ** (attempts - 1), 3600)
+        if failed:
+            logger.error('Job `%s` %d failed permanently: %s', kind, job_id, e)
+        else:
+            logger.warning('Job `%s` %d failed. Retrying in %d seconds: %s',
+                           kind, job_id, delay, e)
+        db.execute('''update jobs set attempts = ?, run_at = ?,
+                      locked_until = 0, failed = ? where id = ?''',
+                   (attempts, time.time() + delay, failed, job_id))
+        return
+    logger.debug('Job `%s` %d finished', kind, job_id)
+    db.execute('delete from jobs where id = ?', (job_id,))
+
+
+def work(interval: float = 1) -> None:
+    '''Continuously process jobs from the queue.
+
+    :param interval: Time in seconds to wait if no job is due
+    '''
+    logger.info('Starting job worker')
+    while True:
+        try:
+            db = database()
+            try:
+                while job := claim(db):
+                    run(db, job)
+            finally:
+                db.close()
+        except Exception as e:
+            logger.exception('Error processing jobs: %s', e)
+        time.sleep(interval)
+
+
+def start_worker() -> None:
+    '''Start a background thread processing queued jobs unless it is running
+    in this process already.
+    '''
+    if __worker and __worker.is_alive():
+        return
+    worker = threading.Thread(target=work, name='leihsldap-jobs', daemon=True)
+    globals()['__worker'] = worker
+    worker.start()
+
+
+def reset_worker() -> None:
+    '''Forget about the worker thread.
+    Threads do not survive forking, so child processes need to start their own.
+    '''
+    globals()['__worker'] = None
+
+
+os.register_at_fork(after_in_child=reset_worker)
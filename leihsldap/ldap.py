@@ -14,51 +14,690 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import json
 import logging
+import os
+import threading
+import time
 
-from ldap3 import Server, Connection, ALL, AUTO_BIND_NO_TLS
+from contextlib import contextmanager
+from typing import Iterator, Optional
 
-from leihsldap.config import config
+from ldap3 import Server, Connection, ALL, BASE, DSA, NONE, SCHEMA, SUBTREE, \
+    SYNC
+from ldap3.core.exceptions import LDAPBindError, LDAPCommunicationError, \
+    LDAPPasswordIsMandatoryError
+from ldap3.protocol.rfc4512 import DsaInfo, SchemaInfo
+from ldap3.utils.conv import escape_filter_chars
+
+from leihsldap import metrics
+from leihsldap.config import config, on_reload, settings
 
 # Logger
 logger = logging.getLogger(__name__)
 
+__pool = None
+__pool_lock = threading.Lock()
+
+# Supported modes for retrieving information from the server
+SERVER_INFO = {'none': NONE, 'dsa': DSA, 'schema': SCHEMA, 'all': ALL}
+
+# Supported strategies for selecting the server to connect to
+STRATEGIES = ('first', 'round_robin', 'latency')
+
+
+class ServerState:
+    '''An LDAP server together with information about its health and
+    latency used to select the server to connect to.
+    '''
+
+    def __init__(self, server: Server):
+        self.server = server
+        self.latency: Optional[float] = None
+        self.ejected_until = 0.0
+
+    def available(self, now: float) -> bool:
+        '''Check if the server is currently considered healthy.
+        '''
+        return now >= self.ejected_until
+
+    def record(self, seconds: float) -> None:
+        '''Record the time an operation took using an exponentially weighted
+        moving average.
+        '''
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency = 0.8 * self.latency + 0.2 * seconds
+
+    def eject(self, duration: float) -> None:
+        '''Stop using the server for a while.
+        '''
+        now = time.monotonic()
+        if self.available(now):
+            logger.warning('Ejecting LDAP server %s for %d seconds',
+                           self.server, duration)
+        self.ejected_until = now + duration
+
+    def admit(self) -> None:
+        '''Use an ejected server again.
+        '''
+        if self.ejected_until:
+            logger.info('Re-admitting LDAP server %s', self.server)
+        self.ejected_until = 0.0
+
+
+class PooledConnection:
+    '''An open LDAP connection together with the bookkeeping data the
+    connection pool needs to decide whether the connection can be reused.
+    '''
+
+    def __init__(self, connection: Connection, state: ServerState):
+        self.connection = connection
+        self.state = state
+        self.created = time.monotonic()
+        self.last_used = self.created
+
+
+class ConnectionPool:
+    '''Pool of open TLS connections to one or more LDAP servers.
+
+    Connections are opened once and then re-bound with the credentials of
+    each user logging in. That way, a login costs a bind and a search on an
+    already established connection instead of a full TCP and TLS handshake.
+
+    If multiple servers are configured, new connections are opened to a
+    server selected by the pool's strategy. Servers which cannot be reached
+    are ejected for a while and re-admitted once a background health check
+    succeeds.
+
+    Pools must not be shared across processes. Use :func:`pool` to get the
+    pool of the current process.
+    '''
+
+    def __init__(self, servers: list[Server], size: int = 4,
+                 idle_timeout: Optional[float] = 300,
+                 max_lifetime: Optional[float] = 3600,
+                 health_check: Optional[float] = 60,
+                 server_info_file: Optional[str] = None,
+                 strategy: str = 'first',
+                 eject_time: float = 30,
+                 receive_timeout: Optional[float] = None,
+                 client_strategy: str = SYNC):
+        '''Create a new connection pool.
+
+        :param servers: LDAP servers to connect to.
+        :param size: Maximum number of idle connections to keep open.
+        :param idle_timeout: Close connections unused for this many seconds.
+        :param max_lifetime: Close connections older than this many seconds.
+        :param health_check: Check connections idle for more than this many
+            seconds before reusing them.
+        :param server_info_file: File to store retrieved server information
+            in, so that other processes do not need to retrieve it again.
+        :param strategy: Strategy for selecting servers. One of `first`,
+            `round_robin` or `latency`.
+        :param eject_time: Time in seconds to stop using unreachable servers.
+        :param receive_timeout: Time in seconds to wait for responses.
+        :param client_strategy: ldap3 client strategy of new connections.
+            Use ``MOCK_SYNC`` to work against an offline directory.
+        '''
+        if strategy not in STRATEGIES:
+            raise ValueError(f'Invalid LDAP server selection `{strategy}`')
+        self.servers = [ServerState(server) for server in servers]
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.health_check = health_check
+        self.server_info_file = server_info_file
+        self.strategy = strategy
+        self.eject_time = eject_time
+        self.receive_timeout = receive_timeout
+        self.client_strategy = client_strategy
+        self.__idle: list[PooledConnection] = []
+        self.__lock = threading.Lock()
+        self.__next = 0
+        self.__closed = threading.Event()
+
+    def __expired(self, pooled: PooledConnection, now: float) -> bool:
+        '''Check if a connection has exceeded its idle time or lifetime or if
+        its server has been ejected.
+        '''
+        if pooled.connection.closed or not pooled.state.available(now):
+            return True
+        if self.idle_timeout and now - pooled.last_used > self.idle_timeout:
+            return True
+        if self.max_lifetime and now - pooled.created > self.max_lifetime:
+            return True
+        return False
+
+    def __healthy(self, pooled: PooledConnection, now: float) -> bool:
+        '''Check if a connection which has been idle for a while is still
+        usable by sending a cheap *Who am I?* request.
+        '''
+        if not self.health_check or now - pooled.last_used < self.health_check:
+            return True
+        try:
+            pooled.connection.extend.standard.who_am_i()
+            return True
+        except LDAPCommunicationError as e:
+            logger.debug('Pooled LDAP connection failed health check: %s', e)
+            return False
+
+    def candidates(self) -> list[ServerState]:
+        '''Get the servers to try connecting to, in order of preference.
+        If all servers are ejected, all of them are tried anyway, starting
+        with the one to be re-admitted next.
+
+        :returns: List of servers
+        '''
+        now = time.monotonic()
+        available = [state for state in self.servers if state.available(now)]
+        if not available:
+            return sorted(self.servers, key=lambda state: state.ejected_until)
+        if self.strategy == 'round_robin':
+            with self.__lock:
+                start = self.__next % len(available)
+                self.__next += 1
+            return available[start:] + available[:start]
+        if self.strategy == 'latency':
+            # Servers without measurements come first to get measured
+            return sorted(available, key=lambda state: state.latency or 0)
+        return available
+
+    def __connect(self, state: ServerState) -> Connection:
+        '''Open a new connection to an LDAP server, measuring its latency.
+        '''
+        logger.debug('Opening new LDAP connection to %s', state.server)
+        connection = Connection(state.server,
+                                client_strategy=self.client_strategy,
+                                receive_timeout=self.receive_timeout)
+        start = time.perf_counter()
+        with metrics.timed('ldap_connect'):
+            connection.open(read_server_info=False)
+        state.record(time.perf_counter() - start)
+        return connection
+
+    def __open(self) -> PooledConnection:
+        '''Open a new connection to the best available LDAP server.
+
+        :raises LDAPCommunicationError: If no server could be reached.
+        '''
+        error = LDAPCommunicationError('No LDAP server configured')
+        for state in self.candidates():
+            try:
+                return PooledConnection(self.__connect(state), state)
+            except LDAPCommunicationError as e:
+                logger.warning('Could not connect to LDAP server %s: %s',
+                               state.server, e)
+                state.eject(self.eject_time)
+                error = e
+        raise error
+
+    def __take(self) -> Optional[PooledConnection]:
+        '''Take the most recently used, still valid connection from the pool.
+        '''
+        now = time.monotonic()
+        while True:
+            with self.__lock:
+                if not self.__idle:
+                    return None
+                pooled = self.__idle.pop()
+            if not self.__expired(pooled, now) and self.__healthy(pooled, now):
+                return pooled
+            close(pooled.connection)
+
+    def __release(self, pooled: PooledConnection) -> None:
+        '''Return a connection to the pool or close it if the pool is full.
+        '''
+        pooled.last_used = time.monotonic()
+        with self.__lock:
+            if len(self.__idle) < self.size and not self.__closed.is_set():
+                self.__idle.append(pooled)
+                return
+        close(pooled.connection)
+
+    def bind(self, pooled: PooledConnection, user_dn: str,
+             password: str) -> None:
+        '''Bind a pooled connection with the given credentials.
+
+        :raises LDAPBindError: If the credentials are invalid.
+        :raises LDAPCommunicationError: If the connection broke down.
+        '''
+        connection = pooled.connection
+        server = pooled.state.server
+        read_server_info = missing_server_info(server)
+        start = time.perf_counter()
+        try:
+            with metrics.timed('ldap_bind'):
+                bound = connection.rebind(user_dn, password,
+                                          read_server_info=read_server_info)
+        except LDAPBindError as e:
+            # ldap3 reports connections closed by the server as bind errors
+            if connection.closed or \
+                    isinstance(e.__context__, LDAPCommunicationError):
+                raise LDAPCommunicationError(
+                        f'Connection lost during bind: {e}') from e
+            raise
+        pooled.state.record(time.perf_counter() - start)
+        if not bound:
+            if connection.closed:
+                raise LDAPCommunicationError('Connection lost during bind: '
+                                             f'{connection.last_error}')
+            raise LDAPBindError(connection.last_error)
+        if read_server_info and self.server_info_file:
+            save_server_info(server, self.server_info_file)
+
+    def __bound(self, user_dn: str, password: str) -> PooledConnection:
+        '''Get a pooled or new connection bound with the given credentials.
+        New connections failing to bind because of communication errors are
+        retried with the next server.
+        '''
+        pooled = self.__take()
+        if pooled:
+            try:
+                self.bind(pooled, user_dn, password)
+                return pooled
+            except LDAPCommunicationError as e:
+                logger.info('Pooled LDAP connection broken: %s', e)
+                close(pooled.connection)
+            except Exception:
+                self.__release(pooled)
+                raise
+
+        for attempt in range(len(self.servers)):
+            pooled = self.__open()
+            try:
+                self.bind(pooled, user_dn, password)
+                return pooled
+            except LDAPCommunicationError as e:
+                close(pooled.connection)
+                pooled.state.eject(self.eject_time)
+                if attempt + 1 == len(self.servers):
+                    raise
+                logger.warning('LDAP bind failed on %s. Trying next server: '
+                               '%s', pooled.state.server, e)
+            except Exception:
+                self.__release(pooled)
+                raise
+        raise LDAPCommunicationError('No LDAP server configured')
+
+    @contextmanager
+    def connection(self, user_dn: str, password: str) -> Iterator[Connection]:
+        '''Get a connection bound with the given credentials.
+        The connection is returned to the pool afterwards.
+
+        :param user_dn: Distinguished name to bind with.
+        :param password: Password to bind with.
+        :raises LDAPPasswordIsMandatoryError: If the password is empty.
+        :raises LDAPBindError: If the credentials are invalid.
+        :raises LDAPCommunicationError: If no server could be reached.
+        '''
+        if not password:
+            # Prevent unauthenticated binds which most servers allow
+            raise LDAPPasswordIsMandatoryError('Password must not be empty')
+        pooled = self.__bound(user_dn, password)
+        try:
+            yield pooled.connection
+        except LDAPCommunicationError:
+            close(pooled.connection)
+            pooled.state.eject(self.eject_time)
+            raise
+        except Exception:
+            self.__release(pooled)
+            raise
+        else:
+            self.__release(pooled)
+
+    def warm(self) -> None:
+        '''Open a connection to the best available server unless an idle
+        connection is available already, so that the next login does not
+        need to wait for the connection to be established.
+
+        :raises LDAPCommunicationError: If no server could be reached.
+        '''
+        with self.__lock:
+            if self.__idle:
+                return
+        self.__release(self.__open())
+
+    def probe(self, state: ServerState) -> bool:
+        '''Check if a server is reachable, re-admitting or ejecting it
+        accordingly.
+
+        :param state: Server to check
+        :returns: If the server is reachable
+        '''
+        try:
+            close(self.__connect(state))
+        except LDAPCommunicationError as e:
+            logger.debug('Health check of LDAP server %s failed: %s',
+                         state.server, e)
+            state.eject(self.eject_time)
+            return False
+        state.admit()
+        return True
+
+    def start_health_checks(self, interval: float) -> None:
+        '''Periodically check all servers in a background thread.
+        Stops once the pool is closed.
+
+        :param interval: Time in seconds between checks
+        '''
+        def check():
+            while not self.__closed.wait(interval):
+                for state in self.servers:
+                    self.probe(state)
+
+        threading.Thread(target=check, name='leihsldap-ldap-health',
+                         daemon=True).start()
+
+    def close(self) -> None:
+        '''Close all idle connections and stop health checks.
+        Connections in use are closed when they are released.
+        '''
+        self.__closed.set()
+        with self.__lock:
+            idle, self.__idle = self.__idle, []
+        for pooled in idle:
+            close(pooled.connection)
+
+
+def close(connection: Connection) -> None:
+    '''Close a connection, ignoring any errors.
+    '''
+    try:
+        connection.unbind()
+    except Exception as e:
+        logger.debug('Error closing LDAP connection: %s', e)
+
+
+def missing_server_info(server: Server) -> bool:
+    '''Check if server information requested by the server's ``get_info``
+    mode still needs to be retrieved.
+
+    :param server: LDAP server
+    :returns: If information needs to be retrieved
+    '''
+    if server.get_info in (DSA, ALL) and server.info is None:
+        return True
+    return server.get_info in (SCHEMA, ALL) and server.schema is None
+
+
+def load_server_info(server: Server, filename: str) -> bool:
+    '''Load server information from a snapshot file written by
+    :func:`save_server_info`.
+
+    :param server: LDAP server to attach the information to
+    :param filename: Snapshot file
+    :returns: If the snapshot has been loaded
+    '''
+    if not os.path.isfile(filename):
+        return False
+    logger.info('Loading LDAP server information from %s', filename)
+    with open(filename, 'r') as f:
+        snapshot = json.load(f)
+    if snapshot.get('info'):
+        server.attach_dsa_info(DsaInfo.from_json(snapshot['info']))
+    if snapshot.get('schema'):
+        server.attach_schema_info(SchemaInfo.from_json(snapshot['schema']))
+    return True
+
+
+def save_server_info(server: Server, filename: str) -> None:
+    '''Write the server information retrieved from the LDAP server to a
+    snapshot file. The file is replaced atomically to ensure that other
+    processes never read a partially written snapshot.
+
+    :param server: LDAP server
+    :param filename: Snapshot file
+    '''
+    snapshot = {
+        'info': server.info.to_json() if server.info else None,
+        'schema': server.schema.to_json() if server.schema else None,
+        }
+    logger.info('Writing LDAP server information to %s', filename)
+    tmpfile = f'{filename}.{os.getpid()}'
+    try:
+        with open(tmpfile, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmpfile, filename)
+    except OSError as e:
+        logger.warning('Could not write LDAP server information: %s', e)
+
+
+def servers() -> list[Server]:
+    '''Create the LDAP server objects based on the configuration.
+    Depending on the configured ``server_info`` mode, information about the
+    servers is retrieved once per process or loaded from a snapshot file.
+
+    :returns: LDAP servers
+    '''
+    mode = (config('ldap', 'server_info') or 'all').lower()
+    if mode not in SERVER_INFO:
+        raise ValueError(f'Invalid LDAP server_info mode `{mode}`')
+    hosts = config('ldap', 'server')
+    if isinstance(hosts, str):
+        hosts = [hosts]
+    snapshot = config('ldap', 'server_info_file')
+    result = []
+    for host in hosts:
+        server = Server(host,
+                        port=config('ldap', 'port'),
+                        use_ssl=True,
+                        get_info=SERVER_INFO[mode],
+                        connect_timeout=config('ldap', 'connect_timeout'))
+        if snapshot and mode != 'none':
+            load_server_info(server, snapshot)
+        result.append(server)
+    return result
+
+
+def pool() -> ConnectionPool:
+    '''Get the LDAP connection pool of the current process, creating it if
+    necessary.
+
+    :returns: Connection pool
+    '''
+    if not __pool:
+        with __pool_lock:
+            if not __pool:
+                globals()['__pool'] = create_pool()
+    return __pool  # type: ignore
+
+
+def create_pool() -> ConnectionPool:
+    '''Create a new LDAP connection pool based on the configuration.
+
+    :returns: Connection pool
+    '''
+    new_pool = ConnectionPool(
+            servers(),
+            size=config('ldap', 'pool', 'size') or 4,
+            idle_timeout=config('ldap', 'pool', 'idle_timeout'),
+            max_lifetime=config('ldap', 'pool', 'max_lifetime'),
+            health_check=config('ldap', 'pool', 'health_check'),
+            server_info_file=config('ldap', 'server_info_file'),
+            strategy=config('ldap', 'selection') or 'first',
+            eject_time=config('ldap', 'eject_time') or 30,
+            receive_timeout=config('ldap', 'receive_timeout'))
+    interval = config('ldap', 'health_interval')
+    if interval and len(new_pool.servers) > 1:
+        new_pool.start_health_checks(interval)
+    return new_pool
+
+
+def reset_pool() -> None:
+    '''Drop the connection pool without closing its connections.
+    This is used after forking since connections must not be shared between
+    processes.
+    '''
+    globals()['__pool'] = None
+    globals()['__pool_lock'] = threading.Lock()
+
+
+def install_pool(new_pool: ConnectionPool) -> None:
+    '''Replace the connection pool of the current process, e.g. with a pool
+    using an offline directory for benchmarking.
+
+    :param new_pool: Connection pool to use
+    '''
+    close_pool()
+    globals()['__pool'] = new_pool
+
+
+def close_pool() -> None:
+    '''Close and drop the connection pool.
+    '''
+    if __pool:
+        __pool.close()
+    reset_pool()
+
+
+os.register_at_fork(after_in_child=reset_pool)
+on_reload(close_pool)
+
 
-def ldap_login(username: str, password: str) -> dict[str, list]:
+def fetch_entry(conn: Connection, search_base: str, search_filter: str,
+                scope: str = SUBTREE) -> tuple[str, dict[str, list]]:
+    '''Search for a single entry, requesting only the configured attributes.
+
+    :param conn: Bound LDAP connection
+    :param search_base: Base of the search
+    :param search_filter: Filter of the search
+    :param scope: Scope of the search
+    :returns: Tuple of the entry's distinguished name and its attributes
+    :raises ValueError: If the search does not return exactly one entry
+    '''
+    with metrics.timed('ldap_search'):
+        conn.search(search_base, search_filter, search_scope=scope,
+                    attributes=list(settings().ldap_attributes))
+    if len(conn.entries) != 1:
+        raise ValueError('Search must return exactly one result',
+                         conn.entries)
+    entry = conn.entries[0]
+    return entry.entry_dn, entry.entry_attributes_as_dict
+
+
+def search_user(conn: Connection, username: str) -> dict[str, list]:
+    '''Find a user's entry by searching the subtree below ``base_dn``.
+
+    :param conn: Bound LDAP connection
+    :param username: The user's username
+    :returns: User attributes
+    '''
+    cfg = settings()
+    search_filter = cfg.search_filter.format(username=username)
+    return fetch_entry(conn, cfg.base_dn, search_filter)[1]
+
+
+def read_user(conn: Connection, user_dn: str) -> dict[str, list]:
+    '''Read a user's entry directly using its distinguished name.
+    This avoids a search of the directory.
+
+    :param conn: Bound LDAP connection
+    :param user_dn: The user's distinguished name
+    :returns: User attributes
+    '''
+    return fetch_entry(conn, user_dn, '(objectClass=*)', BASE)[1]
+
+
+def find_user(username: str) -> tuple[str, dict[str, list]]:
+    '''Search for a user's entry using the service account.
+    This is used for directories where the user's distinguished name cannot
+    be derived from the username.
+
+    :param username: The user's username
+    :returns: Tuple of the user's distinguished name and attributes
+    :raises LDAPBindError: If no unique user could be found. This is treated
+        like invalid credentials to not reveal which users exist.
+    '''
+    cfg = settings()
+    search_filter = cfg.search_filter.format(
+            username=escape_filter_chars(username))
+    with pool().connection(cfg.service_dn, cfg.service_password) as conn:
+        try:
+            return fetch_entry(conn, cfg.base_dn, search_filter)
+        except ValueError as e:
+            logger.info('Could not find user `%s`: %s', username, e)
+            raise LDAPBindError('User not found')
+
+
+def lookup_user(username: str) -> tuple[str, dict[str, list]]:
+    '''Get a user's entry using the service account, without knowing the
+    user's password. Depending on the configured lookup mode, the user is
+    searched for or the user's entry is read directly.
+
+    :param username: The user's username
+    :returns: Tuple of the user's distinguished name and attributes
+    :raises LDAPBindError: If no unique user could be found
+    :raises ValueError: If the user's entry could not be read
+    '''
+    cfg = settings()
+    if cfg.ldap_lookup == 'service_account':
+        return find_user(username)
+    user_dn = cfg.user_dn.format(username=username)
+    with pool().connection(cfg.service_dn, cfg.service_password) as conn:
+        return user_dn, read_user(conn, user_dn)
+
+
+def user_attributes(entry: dict[str, list]) -> dict[str, list]:
+    '''Get the configured attributes from an entry.
+
+    :param entry: Attributes of an LDAP entry
+    :returns: Dictionary containing all configured attributes
+    '''
+    # Without schema information, the server decides about the case of the
+    # attribute names and leaves out attributes the user does not have.
+    values = {key.lower(): value for key, value in entry.items()}
+    return {key: values.get(key.lower(), [])
+            for key in settings().ldap_attributes}
+
+
+def ldap_login(username: str, password: str,
+               prefetched: Optional[tuple[str, dict[str, list]]] = None
+               ) -> dict[str, list]:
     '''Login to LDAP and return user attributes.
 
     The idea of this is basically for the user to login to LDAP and request its
     own attributes. Obviously, this code will do that for the user with the
     provided credentials.
 
+    Depending on the configured lookup mode, the user's attributes are
+    searched for after binding (``search``), read directly from the user's
+    entry (``read``) or searched for using a service account before binding
+    with the distinguished name found (``service_account``).
+
+    If the user's entry has already been fetched in advance, only the
+    password is verified.
+
     :param username: Username to log in with.
     :param password: Password to log in with.
+    :param prefetched: Distinguished name and attributes of the user as
+        returned by :func:`lookup_user`.
     :returns: Dictionary containing requested user attributes.
     '''
-    user_dn = config('ldap', 'user_dn').format(username=username)
-
-    logger.debug('Trying to log into LDAP with user_dn `%s`', user_dn)
-    server = Server(config('ldap', 'server'),
-                    port=config('ldap', 'port'),
-                    use_ssl=True,
-                    get_info=ALL)
-    # Note: AUTO_BIND_NO_TLS means no Start TLS
-    # See: https://github.com/cannatag/ldap3/issues/1061
-    conn = Connection(server, user_dn, password, auto_bind=AUTO_BIND_NO_TLS)
-    logger.debug('Login successful with user_dn `%s`', user_dn)
-
-    attributes = list(filter(bool, [
-        config('ldap', 'userdata', 'email', 'field'),
-        config('ldap', 'userdata', 'name', 'family'),
-        config('ldap', 'userdata', 'name', 'given')]))
-    attributes += config('ldap', 'userdata', 'groups', 'fields') or []
-
-    logger.debug('Searching for user data')
-    conn.search(
-            config('ldap', 'base_dn'),
-            config('ldap', 'search_filter').format(username=username),
-            attributes=attributes)
-    if len(conn.entries) != 1:
-        raise ValueError('Search must return exactly one result', conn.entries)
+    cfg = settings()
+    if prefetched:
+        user_dn, entry = prefetched
+        logger.debug('Trying to log into LDAP with prefetched user_dn `%s`',
+                     user_dn)
+        with pool().connection(user_dn, password):
+            logger.debug('Login successful with user_dn `%s`', user_dn)
+    elif cfg.ldap_lookup == 'service_account':
+        logger.debug('Searching for user `%s`', username)
+        user_dn, entry = find_user(username)
+        logger.debug('Trying to log into LDAP with user_dn `%s`', user_dn)
+        with pool().connection(user_dn, password):
+            logger.debug('Login successful with user_dn `%s`', user_dn)
+    else:
+        user_dn = cfg.user_dn.format(username=username)
+        logger.debug('Trying to log into LDAP with user_dn `%s`', user_dn)
+        with pool().connection(user_dn, password) as conn:
+            logger.debug('Login successful with user_dn `%s`', user_dn)
+            logger.debug('Retrieving user data')
+            if cfg.ldap_lookup == 'read':
+                entry = read_user(conn, user_dn)
+            else:
+                entry = search_user(conn, username)
     logger.debug('Found user data')
-    return conn.entries[0].entry_attributes_as_dict
+    return user_attributes(entry)
@@ -14,32 +14,292 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import contextvars
+import hashlib
 import logging
+import os
+import random
 import requests
+import threading
+import time
 
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
+from typing import Iterator, Optional
 
-from leihsldap.config import config
+from leihsldap import jobs, metrics
+from leihsldap.cache import BaseCache, create
+from leihsldap.circuit import CircuitBreaker, CircuitOpen
+from leihsldap.config import Settings, config, on_reload, settings
 
 # Logger
 logger = logging.getLogger(__name__)
 
+# HTTP methods which can safely be retried
+IDEMPOTENT = ('GET', 'HEAD', 'PUT', 'DELETE')
+
+# HTTP status codes indicating a temporary problem worth retrying
+RETRY_STATUS = (502, 503, 504)
+
+__breaker = None
+__lock = threading.Lock()
+__deadline: contextvars.ContextVar[Optional[float]] = \
+    contextvars.ContextVar('deadline', default=None)
+__groups = None
+__initialized: Optional[int] = None
+__memberships = None
+__registered = False
+__session = None
+__users = None
+
+
+def session() -> requests.Session:
+    '''Get the HTTP session of the current process used for all requests
+    against the Leihs API, creating it if necessary.
+    The session keeps connections to Leihs alive and sends the API token
+    with every request.
+
+    :returns: HTTP session
+    '''
+    if not __session:
+        pool_size = config('leihs', 'pool_size') or 10
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        new_session = requests.Session()
+        new_session.mount('http://', adapter)
+        new_session.mount('https://', adapter)
+        new_session.headers.update(settings().api_headers)
+        globals()['__session'] = new_session
+    return __session  # type: ignore
+
+
+def reset_session() -> None:
+    '''Drop the HTTP session without closing its connections.
+    This is used after forking since connections must not be shared between
+    processes.
+    '''
+    globals()['__session'] = None
+    globals()['__breaker'] = None
+
+
+os.register_at_fork(after_in_child=reset_session)
+on_reload(reset_session)
+
+
+class LeihsUnavailable(RuntimeError):
+    '''Leihs could not be reached in time or is known to be unhealthy.
+    '''
+
+
+def breaker() -> CircuitBreaker:
+    '''Get the circuit breaker of the current process guarding requests
+    against the Leihs API, creating it if necessary.
+
+    :returns: Circuit breaker
+    '''
+    if not __breaker:
+        cfg = settings()
+        globals()['__breaker'] = CircuitBreaker(
+                'leihs', threshold=cfg.breaker_threshold,
+                reset_time=cfg.breaker_reset_time)
+    return __breaker  # type: ignore
+
+
+@contextmanager
+def deadline(seconds: Optional[float]) -> Iterator[None]:
+    '''Limit the total time all requests against the Leihs API within this
+    context may take. The deadline is passed on to threads started using
+    :func:`contextvars.copy_context`.
+
+    :param seconds: Time budget in seconds or None for no limit
+    '''
+    if seconds is None:
+        yield
+        return
+    token = __deadline.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        __deadline.reset(token)
+
+
+def remaining() -> Optional[float]:
+    '''Get the remaining time until the current deadline.
+
+    :returns: Remaining time in seconds or None if there is no deadline
+    '''
+    end = __deadline.get()
+    return None if end is None else end - time.monotonic()
+
+
+def timeout(cfg: Settings) -> tuple[float, float]:
+    '''Get connect and read timeout for the next request, limited by the
+    remaining time until the current deadline.
+
+    :param cfg: Settings to take the configured timeouts from
+    :returns: Tuple of connect and read timeout in seconds
+    :raises LeihsUnavailable: If the deadline has passed
+    '''
+    connect, read = cfg.connect_timeout, cfg.read_timeout
+    left = remaining()
+    if left is None:
+        return connect, read
+    if left <= 0:
+        raise LeihsUnavailable('Deadline for Leihs API requests exceeded')
+    return min(connect, left), min(read, left)
+
+
+def known_users() -> BaseCache:
+    '''Get the cache of users known to exist in Leihs, creating it if
+    necessary.
+
+    :returns: User cache
+    '''
+    if __users is None:
+        globals()['__users'] = create(
+                'users',
+                size=config('leihs', 'user_cache', 'size') or 10000,
+                ttl=config('leihs', 'user_cache', 'ttl') or 3600)
+    return __users  # type: ignore
+
+
+def known_groups() -> BaseCache:
+    '''Get the cache mapping group names to Leihs group data, creating it if
+    necessary.
+
+    :returns: Group cache
+    '''
+    if __groups is None:
+        globals()['__groups'] = create(
+                'groups',
+                size=config('leihs', 'group_cache', 'size') or 10000,
+                ttl=config('leihs', 'group_cache', 'ttl') or 3600)
+    return __groups  # type: ignore
+
+
+def synced_groups() -> BaseCache:
+    '''Get the cache mapping usernames to the fingerprint of the groups last
+    synchronized to Leihs, creating it if necessary.
+
+    :returns: Group membership cache
+    '''
+    if __memberships is None:
+        globals()['__memberships'] = create(
+                'memberships',
+                size=config('leihs', 'group_sync', 'cache', 'size') or 10000,
+                ttl=config('leihs', 'group_sync', 'cache', 'ttl') or 3600)
+    return __memberships  # type: ignore
+
+
+def reset_caches() -> None:
+    '''Drop all caches, so that they are created again using the current
+    configuration. Entries of shared caches are kept by their backend.
+    '''
+    globals()['__users'] = None
+    globals()['__groups'] = None
+    globals()['__memberships'] = None
+
+
+on_reload(reset_caches)
+
+
+def fingerprint(groups: list[str]) -> str:
+    '''Calculate a fingerprint of a set of groups which does not depend on
+    the order or on duplicates.
+
+    :param groups: Names of groups
+    :returns: Fingerprint of the groups
+    '''
+    data = '\n'.join(sorted(set(groups)))
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def user_registered(username: str) -> bool:
+    '''Check if a user is known to be registered with Leihs.
+    This only checks the local cache and never contacts Leihs.
+
+    :param username: The user's login
+    :returns: If the user is known to exist in Leihs
+    '''
+    cache = known_users()
+    registered = cache.get(username, False)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('User cache statistics: %s', cache.stats())
+    return registered
+
+
+def forget_user(username: str) -> None:
+    '''Remove a user from the cache of users known to exist in Leihs.
+
+    :param username: The user's login
+    '''
+    known_users().delete(username)
+
 
 def api(method: str, path: str, **kwargs) -> requests.models.Response:
     '''Execute an HTTP request against the Leihs API.
     This uses the API token from the configuration file.
 
+    Idempotent requests failing because of connection problems or temporary
+    server errors are retried with jittered exponential backoff, as long as
+    the current deadline permits. Requests are rejected right away while the
+    circuit breaker considers Leihs to be unhealthy.
+
     :param method: HTTP method to use
     :param path: Path of the request URL
     :returns: HTTP response
+    :raises LeihsUnavailable: If Leihs could not be reached
     '''
-    base_url = config('leihs', 'url', allow_empty=False).rstrip('/')
-    url = f'{base_url}{path}'
-    headers = {'Accept': 'application/json',
-               'Content-Type': 'application/json',
-               'Authorization': 'Token ' + config('leihs', 'api_token')}
-    logger.debug('Sending request to %s', url)
-    return requests.request(method, url, headers=headers, **kwargs)
+    http = session()
+    circuit = breaker()
+    # Use the same settings for all attempts, even if the configuration is
+    # reloaded in between
+    cfg = settings()
+    url = f'{cfg.leihs_url}{path}'
+    backoff = cfg.backoff
+    attempts = 1 + (cfg.retries if method.upper() in IDEMPOTENT else 0)
+    response = None
+    error: Optional[Exception] = None
+
+    for attempt in range(attempts):
+        if attempt:
+            # Full jitter, spreading out retries of concurrent requests
+            delay = random.uniform(0, backoff * 2 ** attempt)  # nosec B311
+            left = remaining()
+            if left is not None and delay >= left:
+                break
+            time.sleep(delay)
+            logger.info('Retrying request to %s', url)
+        request_timeout = timeout(cfg)
+        try:
+            circuit.allow()
+        except CircuitOpen as e:
+            raise LeihsUnavailable(str(e)) from e
+        logger.debug('Sending request to %s', url)
+        start = time.perf_counter()
+        try:
+            response = http.request(method, url, timeout=request_timeout,
+                                    **kwargs)
+        except requests.RequestException as e:
+            circuit.failure()
+            logger.warning('Request to %s failed: %s', url, e)
+            response, error = None, e
+            continue
+        metrics.leihs_api(method, path, response.status_code,
+                          time.perf_counter() - start)
+        if response.status_code < 500:
+            circuit.success()
+            return response
+        circuit.failure()
+        if response.status_code not in RETRY_STATUS:
+            return response
+        logger.warning('Request to %s failed with status %d',
+                       url, response.status_code)
+        error = None
+
+    if response is not None:
+        return response
+    raise LeihsUnavailable(f'Could not reach Leihs: {error}') from error
 
 
 def check(response: requests.models.Response, error_message: str) -> None:
@@ -93,16 +353,55 @@ def register_user(email: str,
         logger.debug('New user created. Adding authentication and groups.')
         check(response, 'Could not create user')
 
-        # add the newly created user to the authentication system
         user_data = response.json()
-        add_user_to_auth(user_data['id'])
-
-        # add user to groups
-        for group in groups:
-            group_data = create_group(group)
-            add_user_to_group(user_data['id'], group_data['id'])
+        joined = True
+        if jobs.enabled():
+            provision_deferred(user_data['id'], groups)
+            # Groups are synchronized on a later login once the job ran
+            joined = not groups
+        else:
+            # add the newly created user to the authentication system
+            add_user_to_auth(user_data['id'])
+
+            # add user to groups
+            # The user exists already, so do not fail the login if this does
+            # not work. If enabled, group synchronization adds missing groups
+            # on the next login.
+            try:
+                join_groups(user_data['id'], groups)
+            except RuntimeError as e:
+                logger.error('Could not add new user to all groups: %s', e)
+                joined = False
+
+        if joined and username and settings().group_sync:
+            synced_groups().set(username, fingerprint(groups))
+    elif username:
+        sync_groups(username, groups)
+
+    if username:
+        known_users().set(username, True)
+
+
+def provision_deferred(user_id: str, groups: list[str]) -> None:
+    '''Try adding a newly created user to the authentication system and queue
+    everything else for later processing.
+    If adding the user to the authentication system fails, this is retried
+    by the background worker as well.
+
+    :param user_id: Identifier of the newly created user
+    :param groups: List of groups to add the user to
+    '''
+    try:
+        add_user_to_auth(user_id)
+    except Exception as e:
+        logger.warning('Could not add user to authentication system. '
+                       'Queuing retry: %s', e)
+        jobs.enqueue('auth', user_id=user_id)
+    if groups:
+        jobs.enqueue('groups', user_id=user_id, groups=groups)
 
 
+@jobs.handler('auth')
 def add_user_to_auth(user_id: str) -> None:
     '''Add user to the authentication system.
 
@@ -147,10 +446,28 @@ def register_auth_system() -> None:
     # If we got a 409, the system is already registered and everything is good
     if response.status_code == 409:
         logger.debug('Authentication system was already registered.')
-        return
+    else:
+        # If we got anything else, check for errors
+        check(response, 'Could not register authentication system')
+    globals()['__registered'] = True
 
-    # If we got anything else, check for errors
-    check(response, 'Could not register authentication system')
+
+def ensure_auth_system(interval: float = 5, max_interval: float = 300) -> None:
+    '''Register the authentication system with Leihs unless this has already
+    been done by this process or by the process it was forked from.
+    Failed attempts are retried with growing intervals until they succeed.
+
+    :param interval: Time in seconds to wait before the first retry
+    :param max_interval: Maximum time in seconds to wait between retries
+    '''
+    while not __registered:
+        try:
+            register_auth_system()
+        except Exception as e:
+            logger.warning('Could not register authentication system. '
+                           'Retrying in %d seconds: %s', interval, e)
+            time.sleep(interval)
+            interval = min(interval * 2, max_interval)
 
 
 def create_group(name: str) -> dict:
@@ -159,6 +476,13 @@ def create_group(name: str) -> dict:
     :param name: Name of the group to create. Also used as org_id.
     :returns: Dictionary of user data
     '''
+    # Groups rarely change, so try the cache first
+    cache = known_groups()
+    group = cache.get(name)
+    if group:
+        logger.debug('Using cached data of group %s', name)
+        return group
+
     group_data = {
         'name': name,
         'org_id': name,
@@ -170,7 +494,9 @@ def create_group(name: str) -> dict:
     # If we just created the group, we have all data we need
     if response.status_code != 409:
         check(response, 'Could not create group')
-        return response.json()
+        group = response.json()
+        cache.set(name, group)
+        return group
 
     # if the group already existed, get the existing group's data
     logger.debug('Group already existed. Getting info from existing group')
@@ -180,9 +506,57 @@ def create_group(name: str) -> dict:
     groups_found = response.json().get('groups', [])
     if len(groups_found) != 1:
         raise RuntimeError(f'Got invalid group data: {groups_found}')
+    cache.set(name, groups_found[0])
     return groups_found[0]
 
 
+def lookup_group(name: str) -> Optional[dict]:
+    '''Get the data of an existing group without creating it.
+
+    :param name: Name of the group, as used by :func:`create_group`
+    :returns: Dictionary of group data or None if the group does not exist
+    '''
+    cache = known_groups()
+    group = cache.get(name)
+    if group:
+        return group
+
+    response = api('get', '/admin/groups/',
+                   params={'org_id': name, 'organization': 'leihs-local'})
+    check(response, 'Could not get group data')
+    groups_found = response.json().get('groups', [])
+    if len(groups_found) != 1:
+        return None
+    cache.set(name, groups_found[0])
+    return groups_found[0]
+
+
+def preload_groups(page_size: int = 1000) -> int:
+    '''Fill the group cache with all local groups existing in Leihs.
+
+    :param page_size: Number of groups to request at once
+    :returns: Number of cached groups
+    '''
+    cache = known_groups()
+    count = 0
+    page = 1
+    while True:
+        response = api('get', '/admin/groups/',
+                       params={'page': page, 'per-page': page_size})
+        check(response, 'Could not get group data')
+        groups = response.json().get('groups', [])
+        for group in groups:
+            if group.get('organization') == 'leihs-local' \
+                    and group.get('org_id'):
+                cache.set(group['org_id'], group)
+                count += 1
+        if len(groups) < page_size:
+            break
+        page += 1
+    logger.info('Cached %d groups', count)
+    return count
+
+
 def add_user_to_group(user_id: str, group_id: str):
     '''Add a user to a group in Leihs.
 
@@ -193,3 +567,222 @@ def add_user_to_group(user_id: str, group_id: str):
     response = api('put', f'/admin/groups/{group_id}/users/{user_id}')
     check(response, 'Could not add user to group')
     return response
+
+
+@jobs.handler('groups')
+def join_groups(user_id: str, groups: list[str]) -> None:
+    '''Add a user to several groups concurrently.
+    Groups which could not be joined are retried. If this still fails, all
+    errors are reported together.
+
+    :param user_id: Identifier of the user to add
+    :param groups: Names of the groups to add the user to
+    :raises RuntimeError: If the user could not be added to all groups
+    '''
+    cfg = settings()
+    parallelism = cfg.group_parallelism
+    retries = cfg.group_retries
+    pending = list(dict.fromkeys(groups))
+    errors = {}
+    for attempt in range(retries + 1):
+        if not pending:
+            return
+        if attempt:
+            logger.info('Retrying to add user `%s` to groups %s',
+                        user_id, pending)
+        workers = min(parallelism, len(pending))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Pass on the deadline of the current login
+            futures = {group: executor.submit(
+                           contextvars.copy_context().run,
+                           join_group, user_id, group)
+                       for group in pending}
+        errors = {}
+        for group, future in futures.items():
+            if error := future.exception():
+                logger.warning('Could not add user `%s` to group `%s`: %s',
+                               user_id, group, error)
+                errors[group] = error
+        pending = list(errors)
+    if errors:
+        raise RuntimeError('\n'.join(
+            [f'Could not add user {user_id} to {len(errors)} groups'] +
+            [f'{group}: {error}' for group, error in errors.items()]))
+
+
+def join_group(user_id: str, name: str):
+    '''Add a user to a group identified by its name.
+    The group is created if it does not exist yet.
+
+    If Leihs cannot find the group, it may have been deleted after we cached
+    its identifier. In that case, the cache entry is dropped and the group
+    is looked up or created once again.
+
+    :param user_id: Identifier of the user to add
+    :param name: Name of the group to add the user to
+    '''
+    group_id = create_group(name)['id']
+    logger.debug('Trying to add user `%s` to group `%s`.', user_id, group_id)
+    response = api('put', f'/admin/groups/{group_id}/users/{user_id}')
+    if response.status_code == 404:
+        logger.info('Group `%s` not found. Dropping it from cache.', name)
+        known_groups().delete(name)
+        return add_user_to_group(user_id, create_group(name)['id'])
+    check(response, 'Could not add user to group')
+    return response
+
+
+def find_user(username: str) -> dict:
+    '''Look up a user in Leihs by login.
+
+    :param username: The user's login
+    :returns: Dictionary of user data
+    :raises RuntimeError: If the user could not be found
+    '''
+    response = api('get', '/admin/users/', params={'term': username})
+    check(response, 'Could not get user data')
+    for user in response.json().get('users', []):
+        if user.get('login') == username:
+            return user
+    raise RuntimeError(f'Could not find user {username}')
+
+
+def user_groups(user_id: str, page_size: int = 1000) -> dict[str, dict]:
+    '''Get the groups managed by this authenticator a user is a member of.
+    These are local groups whose org_id matches their name, as created by
+    :func:`create_group`.
+
+    :param user_id: Identifier of the user
+    :param page_size: Number of groups to request at once
+    :returns: Dictionary mapping group names to group data
+    '''
+    groups = {}
+    page = 1
+    while True:
+        response = api('get', '/admin/groups/',
+                       params={'including-user': user_id,
+                               'page': page,
+                               'per-page': page_size})
+        check(response, 'Could not get group data')
+        found = response.json().get('groups', [])
+        for group in found:
+            if group.get('organization') == 'leihs-local' \
+                    and group.get('org_id') \
+                    and group.get('org_id') == group.get('name'):
+                groups[group['org_id']] = group
+        if len(found) < page_size:
+            return groups
+        page += 1
+
+
+def leave_group(user_id: str, group_id: str) -> None:
+    '''Remove a user from a group in Leihs.
+
+    :param user_id: Identifier of the user to remove
+    :param group_id: Identifier of the group to remove the user from
+    '''
+    logger.debug('Trying to remove user `%s` from group `%s`.',
+                 user_id, group_id)
+    response = api('delete', f'/admin/groups/{group_id}/users/{user_id}')
+    if response.status_code != 404:
+        check(response, 'Could not remove user from group')
+
+
+def sync_groups(username: str, groups: list[str]) -> None:
+    '''Make sure an existing user's group memberships in Leihs match the
+    groups from LDAP if group synchronization is enabled.
+
+    The fingerprint of the last synchronized groups is cached, so that users
+    whose groups did not change cause no additional requests. Errors are
+    logged but do not prevent the user from logging in. They are retried on
+    the user's next login.
+
+    :param username: The user's login
+    :param groups: Names of the groups the user should be a member of
+    '''
+    if not settings().group_sync:
+        return
+    cache = synced_groups()
+    current = fingerprint(groups)
+    if cache.get(username) == current:
+        logger.debug('Groups of user `%s` did not change', username)
+        return
+
+    if jobs.enabled():
+        # The job stores the fingerprint once the memberships are updated
+        jobs.enqueue('memberships', username=username, groups=groups)
+        return
+
+    try:
+        reconcile_groups(username, groups)
+    except Exception as e:
+        logger.warning('Could not synchronize groups of user `%s`: %s',
+                       username, e)
+
+
+@jobs.handler('memberships')
+def reconcile_groups(username: str, groups: list[str]) -> None:
+    '''Add a user to missing groups and, if configured, remove the user from
+    groups managed by this authenticator the user should no longer be a
+    member of. Only the necessary changes are sent to Leihs.
+
+    :param username: The user's login
+    :param groups: Names of the groups the user should be a member of
+    :raises RuntimeError: If the memberships could not be updated
+    '''
+    user_id = find_user(username)['id']
+    current = user_groups(user_id)
+    wanted = set(groups)
+
+    missing = [group for group in dict.fromkeys(groups)
+               if group not in current]
+    if missing:
+        logger.info('Adding user `%s` to groups %s', username, missing)
+        join_groups(user_id, missing)
+
+    if settings().group_sync_remove:
+        for name, group in current.items():
+            if name not in wanted:
+                logger.info('Removing user `%s` from group `%s`',
+                            username, name)
+                leave_group(user_id, group['id'])
+
+    synced_groups().set(username, fingerprint(groups))
+
+
+def initialize() -> None:
+    '''Prepare Leihs and the current process for use with this authenticator.
+    This starts processing queued jobs, optionally fills the group cache and
+    registers the authentication system, retrying until this succeeds.
+    '''
+    # Process queued provisioning jobs in the background
+    if jobs.enabled():
+        jobs.start_worker()
+
+    # Optionally, fill the group cache
+    if config('leihs', 'group_cache', 'preload'):
+        logger.info('Loading groups from Leihs')
+        try:
+            preload_groups()
+        except Exception as e:
+            logger.warning('Could not preload groups: %s', e)
+
+    # Try to register auth system
+    if not __registered:
+        logger.info('Trying to register authentication system')
+        ensure_auth_system()
+
+
+def start() -> None:
+    '''Initialize the current process in a background thread unless this has
+    already been done. Call this on every request. It returns immediately,
+    so that requests never wait for Leihs to become available.
+    '''
+    if __initialized == os.getpid():
+        return
+    with __lock:
+        if __initialized == os.getpid():
+            return
+        globals()['__initialized'] = os.getpid()
+    threading.Thread(target=initialize, name='leihsldap-init',
+                     daemon=True).start()
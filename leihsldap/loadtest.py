@@ -0,0 +1,359 @@
+# LDAP based authentication handler for Leihs
+# Copyright 2022 ELAN e.V.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+Load generator replaying realistic login traffic against a running instance.
+
+Request tokens are signed with the configured key just like Leihs would sign
+them. Each simulated login requests the login page, submits the form and
+checks the redirect back to Leihs. Users are mixed between new and returning
+users and a share of the logins uses a wrong password.
+
+Load is generated either closed-loop with a fixed number of concurrent users
+or open-loop with a fixed arrival rate. In the latter case, the latency of a
+complete login is measured from the time it was scheduled, so that a slow
+server is not hidden by fewer logins being started.
+'''
+
+import logging
+import random
+import threading
+import time
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
+import jwt
+import requests
+
+from leihsldap.config import config, settings
+
+# Logger
+logger = logging.getLogger(__name__)
+
+# Path Leihs sends users back to after signing in
+SIGN_IN_PATH = '/sign-in/external-authentication/{id}/sign-in'
+
+
+@dataclass(frozen=True)
+class User:
+    '''User to simulate logins for.
+    '''
+    login: str
+    password: str
+
+
+def load_users(filename: str) -> list[User]:
+    '''Load users from a file containing one login and password per line,
+    separated by white space.
+
+    :param filename: Path to the file
+    :returns: List of users
+    '''
+    users = []
+    with open(filename, 'r') as f:
+        for line in f:
+            if not line.strip() or line.startswith('#'):
+                continue
+            login, password = line.strip().split(None, 1)
+            users.append(User(login, password))
+    if not users:
+        raise ValueError(f'No users found in {filename}')
+    return users
+
+
+def request_token(email: str, login: Optional[str] = None,
+                  validity: int = 300) -> str:
+    '''Create a request token the way Leihs does.
+    Leihs only sends the login for users it already knows.
+
+    :param email: Email address or name the user entered in Leihs
+    :param login: Login of a registered user
+    :param validity: Number of seconds the token is valid
+    :returns: Signed token
+    '''
+    data = {'email': email,
+            'server_base_url': config('leihs', 'url'),
+            'path': SIGN_IN_PATH.format(id=config('auth-system', 'id')),
+            'exp': int(time.time()) + validity}
+    if login:
+        data['login'] = login
+    return jwt.encode(data, settings().signing_key, 'ES256')
+
+
+class Statistics:
+    '''Thread-safe collection of latencies by stage and result.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples: dict[tuple[str, str], list[float]] = defaultdict(list)
+        self.start = time.monotonic()
+        self.end: Optional[float] = None
+
+    def add(self, stage: str, result: str, seconds: float) -> None:
+        '''Record the duration of a stage.
+
+        :param stage: Name of the stage
+        :param result: Status code or other result of the stage
+        :param seconds: Duration in seconds
+        '''
+        with self.lock:
+            self.samples[(stage, result)].append(seconds)
+
+    def stop(self) -> None:
+        '''Mark the end of the measurement.
+        '''
+        self.end = time.monotonic()
+
+    def report(self) -> list[dict]:
+        '''Summarize the collected latencies.
+
+        :returns: List of dictionaries with count, throughput and latency
+            percentiles in milliseconds per stage and result
+        '''
+        duration = (self.end or time.monotonic()) - self.start
+        rows = []
+        with self.lock:
+            for (stage, result), samples in sorted(self.samples.items()):
+                samples = sorted(samples)
+                rows.append({
+                    'stage': stage,
+                    'result': result,
+                    'count': len(samples),
+                    'throughput': len(samples) / duration,
+                    **{f'p{p}': percentile(samples, p) * 1000
+                       for p in (50, 95, 99)}})
+        return rows
+
+
+def percentile(samples: list[float], p: int) -> float:
+    '''Get a percentile from sorted samples using the nearest-rank method.
+
+    :param samples: Sorted list of samples
+    :param p: Percentile between 0 and 100
+    :returns: Sample at the given percentile
+    '''
+    rank = max(0, -(-len(samples) * p // 100) - 1)
+    return samples[min(rank, len(samples) - 1)]
+
+
+class LoadTest:
+    '''Simulated logins against a running authenticator.
+
+    :param url: Base URL of the authenticator
+    :param users: Users to log in
+    :param returning: Share of logins by users already known to Leihs
+    :param bad_passwords: Share of logins using a wrong password
+    :param domain: Email domain of new users
+    :param timeout: Timeout of each HTTP request in seconds
+    '''
+
+    def __init__(self, url: str, users: list[User], returning: float = .8,
+                 bad_passwords: float = .05, domain: str = 'example.com',
+                 timeout: float = 30):
+        self.url = url.rstrip('/') + '/'
+        self.users = users
+        self.returning = returning
+        self.bad_passwords = bad_passwords
+        self.domain = domain
+        self.timeout = timeout
+        self.stats = Statistics()
+        self.local = threading.local()
+        # Not used for security purposes, only to mix the simulated traffic
+        self.random = random.Random()  # nosec B311
+
+    def session(self) -> requests.Session:
+        '''Get the HTTP session of the current thread.
+        Sessions keep connections open like browsers of real users would.
+        '''
+        if not getattr(self.local, 'session', None):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def timed(self, stage: str, method: str, **kwargs):
+        '''Send a request and record its duration.
+
+        :param stage: Name of the stage
+        :param method: HTTP method
+        :returns: Response or None if the request failed
+        '''
+        start = time.monotonic()
+        try:
+            response = self.session().request(
+                    method, self.url, allow_redirects=False,
+                    timeout=self.timeout, **kwargs)
+            result = str(response.status_code)
+        except requests.RequestException as e:
+            logger.debug('%s request failed: %s', stage, e)
+            response = None
+            result = type(e).__name__
+        self.stats.add(stage, result, time.monotonic() - start)
+        return response
+
+    def login(self, scheduled: Optional[float] = None) -> str:
+        '''Simulate a single login.
+
+        :param scheduled: Time the login was scheduled for, used as start of
+            the latency of the whole flow
+        :returns: Result of the login
+        '''
+        start = scheduled or time.monotonic()
+        user = self.random.choice(self.users)
+        returning = self.random.random() < self.returning
+        bad_password = self.random.random() < self.bad_passwords
+        kind = ('returning' if returning else 'new') + \
+            ('/bad_password' if bad_password else '')
+
+        # Leihs sends an email address for new and the login for known users
+        token = request_token(f'{user.login}@{self.domain}',
+                              user.login if returning else None)
+        password = user.password + '-invalid' if bad_password \
+            else user.password
+
+        result = 'error'
+        response = self.timed('form', 'get', params={'token': token})
+        if response is not None and response.status_code == 200:
+            response = self.timed('submit', 'post', data={
+                'token': token, 'password': password})
+            result = self.check(response, token)
+        elif response is not None:
+            result = str(response.status_code)
+        self.stats.add('login/' + kind, result, time.monotonic() - start)
+        return result
+
+    def check(self, response: Optional[requests.Response],
+              token: str) -> str:
+        '''Check if a response redirects back to Leihs with a valid success
+        token for the request token.
+
+        :param response: Response to the submitted form
+        :param token: Request token which was submitted
+        :returns: Result of the login
+        '''
+        if response is None:
+            return 'error'
+        if response.status_code != 302:
+            return str(response.status_code)
+        location = urlparse(response.headers.get('Location', ''))
+        success = parse_qs(location.query).get('token', [''])[0]
+        try:
+            data = jwt.decode(success, settings().verification_key,
+                              ['ES256'])
+        except jwt.PyJWTError as e:
+            logger.warning('Invalid success token: %s', e)
+            return 'invalid_redirect'
+        if data.get('sign_in_request_token') != token:
+            return 'invalid_redirect'
+        return 'redirect'
+
+    def closed_loop(self, concurrency: int, duration: float) -> None:
+        '''Run logins with a fixed number of concurrent users, each starting
+        a new login as soon as the previous one finished.
+
+        :param concurrency: Number of concurrent users
+        :param duration: Number of seconds to run
+        '''
+        end = time.monotonic() + duration
+
+        def worker():
+            while time.monotonic() < end:
+                self.login()
+
+        threads = [threading.Thread(target=worker, daemon=True)
+                   for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.stats.stop()
+
+    def open_loop(self, rate: float, duration: float,
+                  concurrency: int) -> None:
+        '''Start logins at a fixed rate, independent of how fast the server
+        responds. Logins which cannot be started because all workers are busy
+        are recorded as dropped.
+
+        :param rate: Logins per second
+        :param duration: Number of seconds to run
+        :param concurrency: Maximum number of logins in progress
+        '''
+        slots = threading.BoundedSemaphore(concurrency)
+        start = time.monotonic()
+
+        def run(scheduled):
+            try:
+                self.login(scheduled)
+            finally:
+                slots.release()
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for i in range(int(rate * duration)):
+                scheduled = start + i / rate
+                time.sleep(max(0, scheduled - time.monotonic()))
+                if not slots.acquire(blocking=False):
+                    self.stats.add('login', 'dropped', 0)
+                    continue
+                executor.submit(run, scheduled)
+        self.stats.stop()
+
+
+def print_report(rows: list[dict]) -> None:
+    '''Print statistics as table.
+
+    :param rows: Statistics as returned by :meth:`Statistics.report`
+    '''
+    print(f'{"stage":<28} {"result":<18} {"count":>7} {"req/s":>8} '
+          f'{"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9}')
+    for row in rows:
+        print(f'{row["stage"]:<28} {row["result"]:<18} {row["count"]:>7} '
+              f'{row["throughput"]:>8.1f} {row["p50"]:>9.1f} '
+              f'{row["p95"]:>9.1f} {row["p99"]:>9.1f}')
+
+
+def loadtest(url: str, users: str, duration: float = 60,
+             concurrency: int = 10, rate: Optional[float] = None,
+             returning: float = .8, bad_passwords: float = .05,
+             domain: str = 'example.com') -> list[dict]:
+    '''Run a load test and print the results.
+
+    :param url: Base URL of the authenticator
+    :param users: File with logins and passwords
+    :param duration: Number of seconds to run
+    :param concurrency: Number of concurrent users, or the maximum number of
+        logins in progress if a rate is set
+    :param rate: Logins per second. Runs closed-loop if not set.
+    :param returning: Share of logins by users already known to Leihs
+    :param bad_passwords: Share of logins using a wrong password
+    :param domain: Email domain of new users
+    :returns: Statistics by stage and result
+    '''
+    test = LoadTest(url, load_users(users), returning=returning,
+                    bad_passwords=bad_passwords, domain=domain)
+    if rate:
+        logger.info('Starting %.1f logins per second for %ds against %s',
+                    rate, duration, url)
+        test.open_loop(rate, duration, concurrency)
+    else:
+        logger.info('Running %d concurrent users for %ds against %s',
+                    concurrency, duration, url)
+        test.closed_loop(concurrency, duration)
+    rows = test.stats.report()
+    print_report(rows)
+    return rows
@@ -0,0 +1,118 @@
+# LDAP based authentication handler for Leihs
+# Copyright 2022 ELAN e.V.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+Load and provide internationalization data.
+'''
+
+import glob
+import logging
+import os
+import yaml
+
+from functools import lru_cache
+from typing import Optional
+from werkzeug.datastructures import LanguageAccept
+from werkzeug.http import parse_accept_header
+
+# Logger
+logger = logging.getLogger(__name__)
+
+# Language to use if the client accepts none of the available languages
+DEFAULT_LANGUAGE = 'en'
+
+__error = {}
+__i18n = {}
+__languages = set()
+
+
+def load() -> None:
+    '''Load error messages and translations for all available languages.
+    '''
+    directory = os.path.dirname(__file__) + '/i18n'
+    files = glob.glob(directory + '/error-*.yml')
+    globals()['__languages'] = {os.path.basename(f)[6:-4] for f in files}
+    logger.info('Detected available languages: %s', __languages)
+
+    for lang in __languages:
+        # load error messages
+        with open(f'{directory}/error-{lang}.yml', 'r') as f:
+            __error[lang] = yaml.safe_load(f)
+
+        # load internationalization file
+        with open(f'{directory}/i18n-{lang}.yml', 'r') as f:
+            __i18n[lang] = yaml.safe_load(f)
+
+    negotiate.cache_clear()
+
+
+def languages() -> set[str]:
+    '''Get the available languages.
+
+    :returns: Set of language codes
+    '''
+    return __languages
+
+
+def language(best_match: Optional[str]) -> str:
+    '''Get the language to use based on the best match of the client's
+    accepted languages, falling back to the default language.
+
+    :param best_match: Best matching available language or None
+    :returns: Language code
+    '''
+    return best_match or DEFAULT_LANGUAGE
+
+
+@lru_cache(maxsize=1024)
+def negotiate(accept_language: Optional[str]) -> str:
+    '''Get the language to use based on the value of a request's
+    ``Accept-Language`` header. Results are cached, since clients usually
+    send one of few different headers.
+
+    :param accept_language: Value of the ``Accept-Language`` header
+    :returns: Language code
+    '''
+    accept = parse_accept_header(accept_language, LanguageAccept)
+    return language(accept.best_match(sorted(__languages)))
+
+
+def errors(lang: str) -> list[str]:
+    '''Get the identifiers of all errors.
+
+    :param lang: Language code
+    :returns: List of error identifiers
+    '''
+    return list(__error[lang])
+
+
+def error(lang: str, error_id: str) -> dict[str, str]:
+    '''Get title and message of an error.
+
+    :param lang: Language code
+    :param error_id: String identifying the error
+    :returns: Copy of the error data
+    '''
+    return __error[lang][error_id].copy()
+
+
+def translations(lang: str) -> dict[str, str]:
+    '''Get the user interface translations.
+
+    :param lang: Language code
+    :returns: Dictionary of translations
+    '''
+    return __i18n[lang]
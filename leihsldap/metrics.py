@@ -0,0 +1,225 @@
+# LDAP based authentication handler for Leihs
+# Copyright 2022 ELAN e.V.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+Prometheus metrics for monitoring the authenticator.
+
+Metrics are only collected if enabled in the configuration and if the optional
+``prometheus_client`` package is installed. The package is imported only once
+metrics are actually used. When running multiple worker processes, set the
+environment variable ``PROMETHEUS_MULTIPROC_DIR`` to an empty directory
+writable by all workers so that metrics are aggregated across processes.
+'''
+
+import os
+import re
+import threading
+import time
+
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional
+
+from leihsldap.config import on_reload, settings
+
+# Identifiers in API paths, replaced to keep the number of labels bounded
+IDENTIFIER = re.compile(
+        r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+
+# Values representing the states of circuit breakers
+CIRCUIT_STATES = {'closed': 0, 'half_open': 1, 'open': 2}
+
+__metrics: Optional['Metrics'] = None
+__checked = False
+__lock = threading.Lock()
+
+
+class Metrics:
+    '''Collection of all metrics.
+    '''
+
+    def __init__(self, prometheus_client: Any):
+        self.prometheus_client = prometheus_client
+        self.stage_seconds = prometheus_client.Histogram(
+                'leihsldap_stage_seconds',
+                'Time spent in the stages of handling a request',
+                ['stage'])
+        self.leihs_api_seconds = prometheus_client.Histogram(
+                'leihsldap_leihs_api_seconds',
+                'Time spent waiting for responses from the Leihs API',
+                ['method', 'endpoint'])
+        self.leihs_api_responses = prometheus_client.Counter(
+                'leihsldap_leihs_api_responses_total',
+                'Responses received from the Leihs API',
+                ['method', 'endpoint', 'status'])
+        self.outcomes = prometheus_client.Counter(
+                'leihsldap_requests_total',
+                'Handled requests by outcome',
+                ['outcome'])
+        self.in_progress = prometheus_client.Gauge(
+                'leihsldap_requests_in_progress',
+                'Requests currently being handled',
+                multiprocess_mode='livesum')
+        self.circuit = prometheus_client.Gauge(
+                'leihsldap_circuit_state',
+                'State of circuit breakers: 0 closed, 1 half-open, 2 open',
+                ['backend'],
+                multiprocess_mode='livemax')
+        self.cache = prometheus_client.Counter(
+                'leihsldap_cache_requests_total',
+                'Cache lookups by cache and result',
+                ['cache', 'result'])
+
+
+def active() -> Optional[Metrics]:
+    '''Get the metrics if they are collected, importing
+    ``prometheus_client`` and creating the metrics on first use.
+
+    :returns: Metrics or None if metrics are not collected
+    '''
+    if not __checked:
+        with __lock:
+            if not __checked and settings().metrics:
+                try:
+                    import prometheus_client
+                    globals()['__metrics'] = Metrics(prometheus_client)
+                except ImportError:
+                    pass
+            globals()['__checked'] = True
+    return __metrics
+
+
+def recheck() -> None:
+    '''Check again if metrics should be collected after the configuration
+    has been reloaded. Metrics, once created, are kept.
+    '''
+    globals()['__checked'] = __metrics is not None
+
+
+on_reload(recheck)
+
+
+def enabled() -> bool:
+    '''Check if metrics are collected and should be exposed.
+
+    :returns: If metrics are enabled and prometheus_client is available
+    '''
+    return active() is not None and settings().metrics
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    '''Measure the time spent in a stage.
+
+    :param stage: Name of the stage
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if metrics := active():
+            metrics.stage_seconds.labels(stage).observe(
+                    time.perf_counter() - start)
+
+
+@contextmanager
+def in_progress() -> Iterator[None]:
+    '''Track a request as being in progress.
+    '''
+    metrics = active()
+    if not metrics:
+        yield
+        return
+    with metrics.in_progress.track_inprogress():
+        yield
+
+
+def outcome(name: str) -> None:
+    '''Count the outcome of a request.
+
+    :param name: Outcome like `success` or an error identifier
+    '''
+    if metrics := active():
+        metrics.outcomes.labels(name).inc()
+
+
+def leihs_api(method: str, path: str, status: int, seconds: float) -> None:
+    '''Record a request against the Leihs API.
+
+    :param method: HTTP method
+    :param path: Request path
+    :param status: HTTP status code of the response
+    :param seconds: Time spent waiting for the response
+    '''
+    if metrics := active():
+        method = method.upper()
+        endpoint = IDENTIFIER.sub('{id}', path)
+        metrics.leihs_api_seconds.labels(method, endpoint).observe(seconds)
+        metrics.leihs_api_responses.labels(
+                method, endpoint, str(status)).inc()
+
+
+def circuit(backend: str, state: str) -> None:
+    '''Record the state of a circuit breaker.
+
+    :param backend: Name of the backend
+    :param state: One of `closed`, `half_open` or `open`
+    '''
+    if metrics := active():
+        metrics.circuit.labels(backend).set(CIRCUIT_STATES[state])
+
+
+def cache(name: str, hit: bool) -> None:
+    '''Count a cache lookup.
+
+    :param name: Name of the cache
+    :param hit: If the lookup was a hit
+    '''
+    if metrics := active():
+        metrics.cache.labels(name, 'hit' if hit else 'miss').inc()
+
+
+def render() -> tuple[bytes, str]:
+    '''Render all metrics in the Prometheus text format.
+    In multiprocess mode, metrics of all worker processes are aggregated.
+
+    :returns: Tuple of metrics data and content type
+    '''
+    metrics = active()
+    if not metrics:
+        raise RuntimeError('Metrics are not enabled')
+    prometheus_client = metrics.prometheus_client
+    registry = prometheus_client.REGISTRY
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        from prometheus_client import multiprocess
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return (prometheus_client.generate_latest(registry),
+            prometheus_client.CONTENT_TYPE_LATEST)
+
+
+def mark_process_dead(pid: int) -> None:
+    '''Remove live metrics of a worker process which has exited.
+    Call this from Gunicorn's ``child_exit`` hook in multiprocess mode.
+
+    :param pid: Process identifier of the exited worker
+    '''
+    if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+        return
+    try:
+        from prometheus_client import multiprocess
+    except ImportError:
+        return
+    multiprocess.mark_process_dead(pid)
@@ -0,0 +1,154 @@
+# LDAP based authentication handler for Leihs
+# Copyright 2022 ELAN e.V.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+Cache of rendered pages.
+
+Error pages only depend on the language and the error, so each of them is
+rendered only once. The login page is rendered once per language with
+placeholders for the request specific values, which are then filled in for
+each request.
+'''
+
+import re
+import threading
+
+from markupsafe import escape
+from typing import Callable, Optional
+
+from leihsldap import messages, metrics
+from leihsldap.config import settings
+
+# Placeholders for request specific values of the login page.
+# They are not changed by HTML escaping.
+PLACEHOLDER = '\x00{}\x00'
+PLACEHOLDERS = re.compile('\x00(token|user)\x00')
+
+# Characters changed by HTML escaping
+ESCAPED = '<&>"\''
+
+# Values used to verify that filling in placeholders yields the same result
+# as rendering the template
+SAMPLE = {'token': 'a.b-c_d' + ESCAPED, 'user': 'ü' + ESCAPED}
+
+
+class PageCache:
+    '''Cache of rendered pages using a given function to render templates.
+    Pages can be cached in several variants, e.g. for different URL prefixes.
+    '''
+
+    def __init__(self, render: Callable[..., str]):
+        '''Create a new page cache.
+
+        :param render: Function rendering a template given its name and
+            context variables
+        '''
+        self.render = render
+        self.__errors: dict[tuple[str, str, str], bytes] = {}
+        self.__login: dict[tuple[str, str], Optional[list[str]]] = {}
+        self.__lock = threading.Lock()
+
+    def error(self, lang: str, error_id: str, variant: str = '') -> bytes:
+        '''Get the error page for an error in a given language.
+
+        :param lang: Language code
+        :param error_id: String identifying the error
+        :param variant: Variant of the page
+        :returns: Rendered error page
+        '''
+        key = (lang, error_id, variant)
+        page = self.__errors.get(key)
+        if page is None:
+            error_data = messages.error(lang, error_id)
+            error_data['leihs_url'] = settings().leihs_url
+            error_data['i18n'] = messages.translations(lang)
+            with metrics.timed('render'):
+                page = self.render('error.html', **error_data).encode()
+            with self.__lock:
+                self.__errors[key] = page
+        return page
+
+    def fragments(self, lang: str) -> Optional[list[str]]:
+        '''Render the login page with placeholders and split it into
+        fragments. Every second fragment is the name of a value to insert.
+
+        :param lang: Language code
+        :returns: List of fragments or None if the template cannot be used
+            with placeholders, e.g. because it modifies the values
+        '''
+        i18n = messages.translations(lang)
+        page = self.render('login.html', i18n=i18n,
+                           **{name: PLACEHOLDER.format(name)
+                              for name in SAMPLE})
+        fragments = PLACEHOLDERS.split(page)
+        expected = self.render('login.html', i18n=i18n, **SAMPLE)
+        if self.fill(fragments, SAMPLE) != expected:
+            return None
+        return fragments
+
+    @staticmethod
+    def fill(fragments: list[str], values: dict[str, str]) -> str:
+        '''Insert escaped values into the fragments of a page.
+
+        :param fragments: Fragments of the page
+        :param values: Values to insert
+        :returns: Page
+        '''
+        return ''.join(
+                str(escape(values[fragment])) if i % 2 else fragment
+                for i, fragment in enumerate(fragments))
+
+    def login(self, lang: str, token: str, user: str,
+              variant: str = '') -> bytes:
+        '''Get the login page.
+
+        :param lang: Language code
+        :param token: Request token to include in the form
+        :param user: Username to show
+        :param variant: Variant of the page
+        :returns: Rendered login page
+        '''
+        key = (lang, variant)
+        if key not in self.__login:
+            fragments = self.fragments(lang)
+            with self.__lock:
+                self.__login[key] = fragments
+        fragments = self.__login[key]
+        values = {'token': token, 'user': user}
+        with metrics.timed('render'):
+            if fragments is None:
+                i18n = messages.translations(lang)
+                return self.render('login.html', i18n=i18n,
+                                   **values).encode()
+            return self.fill(fragments, values).encode()
+
+    def prerender(self, variant: str = '') -> None:
+        '''Render all error pages and prepare the login page for all
+        languages.
+
+        :param variant: Variant of the pages
+        '''
+        for lang in messages.languages():
+            for error_id in messages.errors(lang):
+                self.error(lang, error_id, variant)
+            self.login(lang, '', '', variant)
+
+    def clear(self) -> None:
+        '''Drop all cached pages.
+        '''
+        with self.__lock:
+            self.__errors.clear()
+            self.__login.clear()
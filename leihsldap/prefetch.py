@@ -0,0 +1,204 @@
+# LDAP based authentication handler for Leihs
+# Copyright 2022 ELAN e.V.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+Speculative preparation of logins while users type their password.
+
+When the login page is requested, the token already tells who is about to log
+in. If enabled, work not depending on the password is started in the
+background: A connection to the LDAP server is opened, Leihs is asked whether
+it already knows the user and, if a service account is configured, the user's
+attributes and the identifiers of the user's groups are fetched. Submitting
+the login form then only needs to verify the password.
+
+Prefetching is best effort. If all workers are busy, nothing is prefetched
+and if prefetching is not yet finished when the form is submitted, the login
+proceeds as usual.
+
+Prefetched data are kept in the memory of the process serving the login page.
+They are never written to a shared cache, since the login would trust them.
+Prefetching therefore only helps if the form is submitted to the same
+process, e.g. with the single-process ASGI application.
+'''
+
+import hashlib
+import logging
+import os
+import threading
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional
+
+from leihsldap import admission
+from leihsldap.cache import Cache
+from leihsldap.config import config, on_reload, settings
+from leihsldap.ldap import lookup_user, pool, user_attributes
+from leihsldap.leihs_api import deadline, find_user, known_users, \
+    lookup_group, user_registered
+
+# Logger
+logger = logging.getLogger(__name__)
+
+__executor = None
+__lock = threading.Lock()
+__prefetched = None
+__slots = None
+
+
+def enabled() -> bool:
+    '''Check if prefetching is enabled.
+    '''
+    return settings().prefetch
+
+
+def prefetched() -> Cache:
+    '''Get the cache of prefetch results by token, creating it if necessary.
+
+    :returns: Cache mapping token hashes to futures of prefetch results
+    '''
+    if __prefetched is None:
+        globals()['__prefetched'] = Cache(
+                size=config('prefetch', 'size') or 1024,
+                ttl=config('prefetch', 'ttl') or 60,
+                name='prefetch')
+    return __prefetched  # type: ignore
+
+
+def executor() -> tuple[ThreadPoolExecutor, threading.BoundedSemaphore]:
+    '''Get the thread pool used for prefetching and the semaphore limiting
+    the number of prefetches in progress, creating them if necessary.
+
+    :returns: Thread pool and semaphore
+    '''
+    with __lock:
+        if not __executor:
+            workers = config('prefetch', 'workers') or 2
+            globals()['__executor'] = ThreadPoolExecutor(
+                    max_workers=workers,
+                    thread_name_prefix='leihsldap-prefetch')
+            globals()['__slots'] = threading.BoundedSemaphore(workers)
+    return __executor, __slots  # type: ignore
+
+
+def reset() -> None:
+    '''Drop the thread pool and all prefetched data.
+    This is used after forking since threads do not survive a fork and after
+    the configuration has changed.
+    '''
+    globals()['__executor'] = None
+    globals()['__slots'] = None
+    globals()['__prefetched'] = None
+    globals()['__lock'] = threading.Lock()
+
+
+os.register_at_fork(after_in_child=reset)
+on_reload(reset)
+
+
+def token_key(token: str) -> bytes:
+    '''Get the cache key of a token.
+    '''
+    return hashlib.sha256(token.encode()).digest()
+
+
+def schedule(token: str, user: str, registered: bool) -> None:
+    '''Start prefetching data for a login in the background unless
+    prefetching is disabled, already in progress for this token or all
+    workers are busy.
+
+    :param token: Request token of the login
+    :param user: The user's login
+    :param registered: If Leihs told us it knows the user
+    '''
+    if not enabled():
+        return
+    cache = prefetched()
+    key = token_key(token)
+    if cache.get(key) is not None:
+        return
+    pool_executor, slots = executor()
+    if not slots.acquire(blocking=False):
+        logger.debug('Prefetch workers busy. Skipping user `%s`', user)
+        return
+    future = pool_executor.submit(prefetch, user, registered)
+    future.add_done_callback(lambda _: slots.release())
+    cache.set(key, future)
+
+
+def take(token: str) -> Optional[tuple[str, dict[str, list]]]:
+    '''Get the LDAP entry prefetched for a login, if prefetching has finished
+    successfully. Results are only used once.
+
+    :param token: Request token of the login
+    :returns: Tuple of the user's distinguished name and attributes or None
+    '''
+    if not enabled():
+        return None
+    cache = prefetched()
+    key = token_key(token)
+    future: Optional[Future] = cache.get(key)
+    if future is None:
+        return None
+    cache.delete(key)
+    if not future.done():
+        logger.debug('Prefetching not finished in time')
+        return None
+    if future.exception():
+        return None
+    return future.result()
+
+
+def prefetch(user: str, registered: bool
+             ) -> Optional[tuple[str, dict[str, list]]]:
+    '''Prepare the login of a user.
+    Errors are logged and otherwise ignored since the login will just do the
+    work again.
+
+    :param user: The user's login
+    :param registered: If Leihs told us it knows the user
+    :returns: Tuple of the user's distinguished name and attributes if they
+        could be fetched
+    '''
+    cfg = settings()
+    entry = None
+    try:
+        # Never delay logins by waiting for a free slot
+        with admission.limit('ldap', wait=0):
+            if cfg.service_dn and cfg.service_password:
+                entry = lookup_user(user)
+            else:
+                pool().warm()
+    except Exception as e:
+        logger.debug('Could not prefetch LDAP data of `%s`: %s', user, e)
+
+    if registered or user_registered(user):
+        return entry
+    try:
+        with deadline(cfg.prefetch_timeout), \
+                admission.limit('leihs', wait=0):
+            try:
+                find_user(user)
+                known_users().set(user, True)
+                logger.debug('User `%s` already exists in Leihs', user)
+            except RuntimeError:
+                # New users are added to their groups on registration
+                values = user_attributes(entry[1]) if entry else {}
+                for field in cfg.group_fields:
+                    for group in values.get(field, []):
+                        lookup_group(group)
+    except Exception as e:
+        logger.debug('Could not prefetch Leihs data of `%s`: %s', user, e)
+    return entry
@@ -0,0 +1,202 @@
+# LDAP based authentication handler for Leihs
+# Copyright 2022 ELAN e.V.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+Bulk synchronization of users from LDAP to Leihs.
+
+Users are streamed from LDAP using a paged search and compared with the users
+already known to Leihs. Missing users are registered concurrently, including
+their assignment to the authentication system and to groups, just like they
+would be on their first login.
+'''
+
+import logging
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Optional
+
+from leihsldap.config import config, settings
+from leihsldap.ldap import pool
+from leihsldap.leihs_api import api, check, register_user
+
+# Logger
+logger = logging.getLogger(__name__)
+
+
+def all_values(values: dict, field: str) -> list:
+    '''Get all values of an LDAP attribute.
+
+    :param values: Attributes with lower case names
+    :param field: Attribute name
+    :returns: List of values
+    '''
+    value = values.get(field.lower(), [])
+    return value if isinstance(value, list) else [value]
+
+
+def first_value(values: dict, field: Optional[str]):
+    '''Get the first value of an LDAP attribute.
+
+    :param values: Attributes with lower case names
+    :param field: Attribute name
+    :returns: First value or None
+    '''
+    return (all_values(values, field) or [None])[0] if field else None
+
+
+def directory_users(page_size: int = 500) -> Iterator[dict]:
+    '''Stream users from LDAP using a paged search.
+    This requires a service account allowed to search the directory.
+
+    :param page_size: Number of entries to request per page
+    :returns: Iterator over dictionaries with user data
+    '''
+    cfg = settings()
+    if not cfg.service_dn or not cfg.service_password:
+        raise ValueError('Synchronization requires ldap.service_account')
+    login_field = config('ldap', 'sync', 'login_field') or 'uid'
+    search_filter = config('ldap', 'sync', 'filter') or '(objectClass=person)'
+    attributes = list(cfg.ldap_attributes) + [login_field]
+
+    with pool().connection(cfg.service_dn, cfg.service_password) as conn:
+        entries = conn.extend.standard.paged_search(
+                cfg.base_dn,
+                search_filter,
+                attributes=attributes,
+                paged_size=page_size,
+                generator=True)
+        for entry in entries:
+            if entry.get('type') != 'searchResEntry':
+                continue
+            values = {key.lower(): value
+                      for key, value in entry['attributes'].items()}
+            yield {
+                'login': first_value(values, login_field),
+                'email': first_value(values, cfg.email_field),
+                'firstname': first_value(values, cfg.given_name_field),
+                'lastname': first_value(values, cfg.family_name_field),
+                'groups': [group for field in cfg.group_fields
+                           for group in all_values(values, field)],
+                }
+
+
+def leihs_users(page_size: int = 1000) -> set[str]:
+    '''Get logins and email addresses of all users known to Leihs.
+
+    :param page_size: Number of users to request per page
+    :returns: Set of lower case logins and email addresses
+    '''
+    known = set()
+    count = 0
+    page = 1
+    while True:
+        response = api('get', '/admin/users/',
+                       params={'page': page, 'per-page': page_size})
+        check(response, 'Could not get user data')
+        users = response.json().get('users', [])
+        count += len(users)
+        for user in users:
+            for key in ('login', 'email'):
+                if user.get(key):
+                    known.add(user[key].lower())
+        if len(users) < page_size:
+            break
+        page += 1
+    logger.info('Found %d users in Leihs', count)
+    return known
+
+
+def load_checkpoint(filename: Optional[str]) -> set[str]:
+    '''Load logins of users already synchronized by a previous run.
+
+    :param filename: Checkpoint file
+    :returns: Set of logins
+    '''
+    if not filename or not os.path.isfile(filename):
+        return set()
+    with open(filename, 'r') as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+def sync(dry_run: bool = False, concurrency: int = 8,
+         checkpoint: Optional[str] = None, page_size: int = 500) -> dict:
+    '''Register all LDAP users missing in Leihs.
+
+    :param dry_run: Only log which users would be registered
+    :param concurrency: Number of users to register concurrently
+    :param checkpoint: File recording synchronized users. Users listed in
+        this file are skipped, which allows resuming an interrupted run.
+    :param page_size: Number of LDAP entries to request per page
+    :returns: Statistics about the synchronization
+    '''
+    done = load_checkpoint(checkpoint)
+    known = leihs_users()
+    stats = {'total': 0, 'existing': 0, 'skipped': 0, 'registered': 0,
+             'failed': 0}
+    lock = threading.Lock()
+    slots = threading.BoundedSemaphore(concurrency * 2)
+    checkpoint_file = open(checkpoint, 'a') if checkpoint else None
+
+    def count(key):
+        with lock:
+            stats[key] += 1
+
+    def provision(user):
+        try:
+            register_user(user['email'],
+                          firstname=user['firstname'],
+                          lastname=user['lastname'],
+                          username=user['login'],
+                          groups=user['groups'])
+            count('registered')
+            if checkpoint_file:
+                with lock:
+                    checkpoint_file.write(user['login'] + '\n')
+                    checkpoint_file.flush()
+        except Exception as e:
+            logger.error('Could not register user `%s`: %s', user['login'], e)
+            count('failed')
+        finally:
+            slots.release()
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for user in directory_users(page_size):
+                stats['total'] += 1
+                if not user['login'] or not user['email']:
+                    logger.warning('Skipping user without login or email: %s',
+                                   user)
+                    stats['skipped'] += 1
+                    continue
+                if user['login'] in done or \
+                        user['login'].lower() in known or \
+                        user['email'].lower() in known:
+                    stats['existing'] += 1
+                    continue
+                if dry_run:
+                    logger.info('Would register user: %s', user)
+                    stats['registered'] += 1
+                    continue
+                slots.acquire()
+                executor.submit(provision, user)
+    finally:
+        if checkpoint_file:
+            checkpoint_file.close()
+
+    logger.info('Synchronization finished: %s', stats)
+    return stats
@@ -14,20 +14,22 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import glob
 import logging
 import os
-import yaml
 
-from flask import Flask, request, redirect, render_template
+from flask import Flask, Response, abort, request, redirect, \
+    render_template, url_for
 from functools import wraps
 from jwt.exceptions import DecodeError, ExpiredSignatureError
 from ldap3.core.exceptions import LDAPBindError, LDAPPasswordIsMandatoryError
 
-from leihsldap.authenticator import response_url, token_data
-from leihsldap.config import config
-from leihsldap.ldap import ldap_login
-from leihsldap.leihs_api import register_user, register_auth_system
+from leihsldap import messages, metrics, prefetch
+from leihsldap.admission import Overloaded, RateLimited
+from leihsldap.assets import Assets, stylesheet as style_element
+from leihsldap.authenticator import authenticate, token_data
+from leihsldap.config import config, on_reload, settings
+from leihsldap.leihs_api import LeihsUnavailable, start
+from leihsldap.pages import PageCache
 
 # Logger
 logger = logging.getLogger(__name__)
@@ -35,29 +37,55 @@ logger = logging.getLogger(__name__)
 flask_config = {}
 if config('ui', 'directories', 'template'):
     flask_config['template_folder'] = config('ui', 'directories', 'template')
-if config('ui', 'directories', 'static'):
-    flask_config['static_folder'] = config('ui', 'directories', 'static')
-app = Flask(__name__, **flask_config)
+static_folder = config('ui', 'directories', 'static') \
+    or os.path.join(os.path.dirname(__file__), 'static')
+app = Flask(__name__, static_folder=None, **flask_config)
+assets = Assets(static_folder)
+pages = PageCache(render_template)
+on_reload(pages.clear)
 
-__error = {}
-__i18n = {}
-__languages = []
+
+@app.url_defaults
+def fingerprint(endpoint: str, values: dict) -> None:
+    '''Link fingerprinted static assets which can be cached forever.
+    '''
+    if endpoint == 'static' and 'filename' in values:
+        values['filename'] = assets.url(values['filename'])
+
+
+@app.template_global()
+def stylesheet(filename: str):
+    '''Include a stylesheet in a template. Depending on the configuration,
+    the stylesheet is linked or its content is included in the page.
+
+    :param filename: Name of the stylesheet in the static folder
+    :returns: Style or link element
+    '''
+    return style_element(assets, filename,
+                         url_for('static', filename=filename),
+                         settings().inline_css)
 
 
-def error(error_id: str, code: int) -> tuple[str, int]:
+def language() -> str:
+    '''Get the language best matching the request's accepted languages.
+
+    :returns: Language code
+    '''
+    return messages.negotiate(request.headers.get('Accept-Language'))
+
+
+def error(error_id: str, code: int) -> tuple[bytes, int]:
     '''Generate error page based on data defined in `error.yml` and the given
-    error identifier.
+    error identifier. Error pages are rendered only once per language.
 
     :param error_id: String identifying the error to render.
     :param code: HTTP status code to return.
     :returns: Tuple of data for Flask response
     '''
-    lang = request.accept_languages.best_match(__languages)
+    lang = language()
     logger.debug('Using language: %s', lang)
-    error_data = __error[lang][error_id].copy()
-    error_data['leihs_url'] = config('leihs', 'url').rstrip('/')
-    error_data['i18n'] = __i18n[lang]
-    return render_template('error.html', **error_data), code
+    metrics.outcome(error_id)
+    return pages.error(lang, error_id, request.script_root), code
 
 
 def handle_errors(function):
@@ -67,6 +95,7 @@ def handle_errors(function):
     :param function: Function to wrap.
     '''
     @wraps(function)
+    @metrics.in_progress()
     def wrapper(*args, **kwargs):
         try:
             return function(*args, **kwargs)
@@ -79,31 +108,38 @@ def handle_errors(function):
         except (LDAPBindError, LDAPPasswordIsMandatoryError) as e:
             logger.info('LDAP login failed: %s', e)
             return error('invalid_credentials', 403)
+        except RateLimited as e:
+            logger.info('Login rejected: %s', e)
+            return error('rate_limited', 429)
+        except Overloaded as e:
+            logger.warning('Login rejected: %s', e)
+            return error('overloaded', 503)
+        except LeihsUnavailable as e:
+            logger.warning('Leihs unavailable: %s', e)
+            return error('unavailable', 503)
     return wrapper
 
 
 def init():
-    '''Load internationalization and try to register the authentication system.
+    '''Load internationalization and render pages.
+    This does not contact any backend, so that importing the application is
+    fast and can be done once before forking worker processes.
     '''
-    # load internationalization data
-    files = glob.glob(os.path.dirname(__file__) + '/i18n/error-*.yml')
-    globals()['__languages'] = {os.path.basename(f)[6:-4] for f in files}
-    logger.info('Detected available languages: %s', __languages)
-
-    for lang in __languages:
-        # load error messages
-        i18n_file = os.path.dirname(__file__) + f'/i18n/error-{lang}.yml'
-        with open(i18n_file, 'r') as f:
-            globals()['__error'][lang] = yaml.safe_load(f)
-
-        # load internationalization file
-        i18n_file = os.path.dirname(__file__) + f'/i18n/i18n-{lang}.yml'
-        with open(i18n_file, 'r') as f:
-            globals()['__i18n'][lang] = yaml.safe_load(f)
-
-    # Try to register auth system
-    logger.info('Trying to register authentication system')
-    register_auth_system()
+    messages.load()
+    try:
+        with app.test_request_context():
+            pages.prerender()
+    except Exception as e:
+        logger.warning('Could not render pages in advance: %s', e)
+
+
+@app.before_request
+def initialize_process():
+    '''Start preparing the current process and Leihs in the background when
+    the first request arrives. This includes registering the authentication
+    system unless this was already done before forking.
+    '''
+    start()
 
 
 @app.errorhandler(500)
@@ -125,9 +161,10 @@ def login_page():
     if not token:
         logger.debug('No token provided')
         return error('no_token', 400)
-    _, email, user, _ = token_data(token)
-    i18n = __i18n[request.accept_languages.best_match(__languages)]
-    return render_template('login.html', token=token, user=user, i18n=i18n)
+    _, email, user, registered = token_data(token)
+    prefetch.schedule(token, user, registered)
+    metrics.outcome('login_page')
+    return pages.login(language(), token, user, request.script_root)
 
 
 @app.route('/', methods=['POST'])
@@ -143,37 +180,31 @@ def login():
     token = request.form.get('token')
     password = request.form.get('password')
 
-    # verify token and get login data
-    data, email, user, registered = token_data(token)
-
-    # Login to and get user data from LDAP
-    user_data = ldap_login(user, password)
-
-    # Get list of groups the user should be in
-    group_fields = config('ldap', 'userdata', 'groups', 'fields') or []
-    groups = [group for field in group_fields for group in user_data[field]]
-
-    # Check if to fall back to the LDAP email address
-    email_overwrite = config('ldap', 'userdata', 'email', 'overwrite')
-    email_fallback = config('ldap', 'userdata', 'email', 'fallback')
-    email_invalid = not email or '@' not in email
-    if email_overwrite or email_fallback and email_invalid:
-        email_field = config('ldap', 'userdata', 'email', 'field')
-        email = user_data[email_field][0]
-        data['email'] = email
-
-    # Make sure user is registered with Leihs
-    given = config('ldap', 'userdata', 'name', 'given')
-    family = config('ldap', 'userdata', 'name', 'family')
-    register_user(
-            email,
-            firstname=(user_data[given] or [None])[0],
-            lastname=(user_data[family] or [None])[0],
-            username=user,
-            groups=groups)
-
     # Redirect back to Leihs with success token
-    return redirect(response_url(token, data), code=302)
+    url = authenticate(token, password, request.remote_addr)
+    metrics.outcome('success')
+    return redirect(url, code=302)
+
+
+@app.route('/static/<path:filename>', methods=['GET'], endpoint='static')
+def static(filename: str):
+    '''Serve static files, compressed if the client supports it.
+    '''
+    status, headers, body = assets.response(
+            filename,
+            request.headers.get('Accept-Encoding'),
+            request.headers.get('If-None-Match'))
+    return Response(body, status=status, headers=headers)
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    '''Expose Prometheus metrics if enabled.
+    '''
+    if not metrics.enabled():
+        abort(404)
+    data, content_type = metrics.render()
+    return Response(data, content_type=content_type)
 
 
 init()
@@ -17,6 +17,11 @@ setup(
     url='https://github.com/elan-ev/leihs-ldap-authenticator',
     packages=find_packages(),
     install_requires=read('requirements.txt').split(),
+    extras_require={
+        'brotli': ['brotli'],
+        'metrics': ['prometheus_client'],
+        'redis': ['redis'],
+    },
     include_package_data=True,
     long_description=read('README.md'),
     long_description_content_type='text/markdown'